@@ -0,0 +1,348 @@
+'''
+Load generator for webserver.py and proxyserver.py.
+Starts the server under test on a free local port (for the proxy, a webserver.py origin stands in
+for the internet), drives it with many concurrent clients and prints the results as JSON.
+
+Example: python benchmark.py --target webserver --concurrency 64 --duration 10 --server-args="--mode asyncio"
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 * 1024, 'g': 1024 * 1024 * 1024}
+
+
+def parse_size(text):
+    '''
+    "64k" -> 65536
+    '''
+    text = text.strip().lower().rstrip('b')
+    unit = text[-1] if text and text[-1] in SIZE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def parse_mix(text):
+    '''
+    "1k:70,64k:25,1m:5" -> [(1024, 70), (65536, 25), (1048576, 5)]
+    '''
+    mix = []
+    for item in text.split(','):
+        size, _, weight = item.partition(':')
+        mix.append((parse_size(size), float(weight or 1)))
+    return mix
+
+
+def make_docroot(mix, text):
+    '''
+    Writes one file per size in the mix to a temporary directory
+    '''
+    docroot = tempfile.mkdtemp(prefix='bench_docroot_')
+    names = []
+    for size, _ in mix:
+        name = f"file_{size}.txt" if text else f"file_{size}.bin"
+        with open(os.path.join(docroot, name), 'wb') as f:
+            if text:
+                line = b"the quick brown fox jumps over the lazy dog %d\n"
+                f.write(b"".join(line % i for i in range(size // len(line) + 1))[:size])
+            else:
+                f.write(os.urandom(size))
+        names.append(name)
+    return docroot, names
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with code {process.returncode} before listening on {port}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start listening on port {port}")
+
+
+def start_server(script, arguments, cwd, port):
+    process = subprocess.Popen([sys.executable, os.path.join(HERE, script)] + arguments, cwd=cwd,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port, process)
+    return process
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def rss_bytes(pid):
+    '''
+    Resident memory of pid and its child processes (process mode workers), None if /proc is missing
+    '''
+    if not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+class Results:
+    '''
+    What the clients measured during the recorded part of the run
+    '''
+    def __init__(self):
+        self.latencies = []
+        self.errors = {}
+        self.bytes = 0
+        self.connections = 0
+        self.recording = False
+
+    def error(self, kind):
+        if self.recording:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+async def read_response(reader):
+    '''
+    Reads one response, returns (status, body bytes, whether the connection can be reused)
+    '''
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode('latin-1').split('\r\n')
+    version, status = lines[0].split()[:2]
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    connection = headers.get('connection', '').lower()
+    keep_alive = 'keep-alive' in connection if version == 'HTTP/1.0' else 'close' not in connection
+    if 'content-length' in headers:
+        length = int(headers['content-length'])
+        await reader.readexactly(length)
+    else:
+        length = len(await reader.read())
+        keep_alive = False
+    return int(status), length, keep_alive
+
+
+async def client(host, port, paths, weights, args, results, schedule, stop_at):
+    '''
+    One simulated client, reuses its connection when keep-alive is on and the server allows it
+    '''
+    reader = writer = None
+    while True:
+        # With a target rate every request gets a slot, latency counts from the slot so a
+        # stalled server can't hide its queueing delay (coordinated omission)
+        if schedule is not None:
+            start = schedule['start'] + schedule['next'] / args.rate
+            schedule['next'] += 1
+            delay = start - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            start = time.perf_counter()
+        if start >= stop_at:
+            break
+
+        path = random.choices(paths, weights)[0]
+        request = f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\n"
+        if not args.keepalive:
+            request += "Connection: close\r\n"
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+                results.connections += 1
+            writer.write((request + "\r\n").encode())
+            status, length, keep_alive = await asyncio.wait_for(read_response(reader), args.timeout)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError) as e:
+            results.error(type(e).__name__)
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            continue
+
+        if results.recording:
+            results.latencies.append(time.perf_counter() - start)
+            results.bytes += length
+            if status >= 400:
+                results.error(f"http_{status}")
+        if not (args.keepalive and keep_alive):
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def run_load(host, port, paths, weights, args, server_pid):
+    results = Results()
+    now = time.perf_counter()
+    stop_at = now + args.warmup + args.duration
+    schedule = {'start': now, 'next': 0} if args.rate else None
+    clients = [asyncio.create_task(client(host, port, paths, weights, args, results, schedule, stop_at))
+               for _ in range(args.concurrency)]
+
+    # Warm up (fills the server caches), then record and sample the server's memory
+    await asyncio.sleep(args.warmup)
+    results.recording = True
+    recorded_from = time.perf_counter()
+    peak_rss = rss_bytes(server_pid)
+    while time.perf_counter() < stop_at:
+        await asyncio.sleep(0.5)
+        rss = rss_bytes(server_pid)
+        if rss is not None:
+            peak_rss = max(peak_rss, rss)
+    results.recording = False
+    elapsed = time.perf_counter() - recorded_from
+    await asyncio.gather(*clients)
+    return results, elapsed, peak_rss
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(results, elapsed, peak_rss, args):
+    latencies = sorted(results.latencies)
+    ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        'target': args.target,
+        'server_args': args.server_args,
+        'concurrency': args.concurrency,
+        'keepalive': args.keepalive,
+        'rate': args.rate,
+        'mix': args.mix,
+        'duration': round(elapsed, 3),
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'throughput_mbps': round(results.bytes * 8 / elapsed / 1e6, 2),
+        'latency_ms': {
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50': ms(percentile(latencies, 0.50)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'p999': ms(percentile(latencies, 0.999)),
+            'max': ms(latencies[-1] if latencies else None),
+        },
+        'errors': sum(results.errors.values()),
+        'error_kinds': results.errors,
+        'connections': results.connections,
+        'server_peak_rss_bytes': peak_rss,
+    }
+
+
+def compare(summary, baseline):
+    '''
+    Ratios against an earlier run, above 1 means higher than the baseline
+    '''
+    def ratio(new, old):
+        return round(new / old, 3) if new is not None and old else None
+    return {
+        'throughput_rps': ratio(summary['throughput_rps'], baseline.get('throughput_rps')),
+        'p50': ratio(summary['latency_ms']['p50'], baseline.get('latency_ms', {}).get('p50')),
+        'p99': ratio(summary['latency_ms']['p99'], baseline.get('latency_ms', {}).get('p99')),
+        'server_peak_rss_bytes': ratio(summary['server_peak_rss_bytes'], baseline.get('server_peak_rss_bytes')),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark webserver.py or proxyserver.py")
+    parser.add_argument('--target', choices=['webserver', 'proxy'], default='webserver')
+    parser.add_argument('--server-args', default='', help="extra arguments for the server under test")
+    parser.add_argument('--concurrency', type=int, default=32, help="simultaneous clients")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds recorded")
+    parser.add_argument('--warmup', type=float, default=1.0, help="seconds of unrecorded load first")
+    parser.add_argument('--rate', type=float, default=0, help="total requests/second, 0 means as fast as possible")
+    parser.add_argument('--no-keepalive', dest='keepalive', action='store_false',
+                        help="open a new connection for every request")
+    parser.add_argument('--mix', default='1k:70,64k:25,1m:5', help="file sizes and their weights")
+    parser.add_argument('--text', action='store_true', help="serve text files instead of random bytes")
+    parser.add_argument('--timeout', type=float, default=10.0, help="seconds before a request counts as failed")
+    parser.add_argument('--output', help="also write the JSON report to this file")
+    parser.add_argument('--baseline', help="JSON report of an earlier run to compare against")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    mix = parse_mix(args.mix)
+    docroot, names = make_docroot(mix, args.text)
+    weights = [weight for _, weight in mix]
+    workdir = tempfile.mkdtemp(prefix='bench_work_')
+    servers = []
+    try:
+        origin_port = free_port()
+        servers.append(start_server('webserver.py', ['--port', str(origin_port)] +
+                                    (shlex.split(args.server_args) if args.target == 'webserver' else []),
+                                    docroot, origin_port))
+        if args.target == 'webserver':
+            port, paths = origin_port, ['/' + name for name in names]
+        else:
+            port = free_port()
+            servers.append(start_server('proxyserver.py', ['--port', str(port), '--cache-dir',
+                                        os.path.join(workdir, 'web_cache')] + shlex.split(args.server_args),
+                                        workdir, port))
+            paths = [f'/127.0.0.1:{origin_port}/{name}' for name in names]
+
+        results, elapsed, peak_rss = asyncio.run(run_load('127.0.0.1', port, paths, weights, args, servers[-1].pid))
+    finally:
+        for server in reversed(servers):
+            stop_server(server)
+        shutil.rmtree(docroot, ignore_errors=True)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = summarize(results, elapsed, peak_rss, args)
+    if args.baseline:
+        with open(args.baseline) as f:
+            summary['vs_baseline'] = compare(summary, json.load(f))
+    report = json.dumps(summary, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
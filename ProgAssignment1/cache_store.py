@@ -0,0 +1,331 @@
+'''
+Disk store behind the proxyserver.py cache.
+Responses live under objects/ in paths sharded by the SHA-256 of their key, and a sqlite index
+keeps each entry's file, size, metadata, last access and hit count. The total size is held to a
+byte budget by evicting the least recently (or least frequently) used entries. Files are written
+under tmp/ and renamed into place when complete, so a partial download is never a cache hit.
+Every process opens its own CacheStore, sqlite keeps the index consistent between them.
+A MemoryCache in front of it keeps the bodies of small hot responses, so they are served
+without touching the filesystem while large ones are sent from disk with sendfile.
+Each MemoryCache belongs to one process, so a memory hit is checked against the version in the
+index, which another process may have replaced or invalidated since.
+The index outlives the process, so a restarted proxy knows its entries without scanning the
+directories, and the hit counts it keeps tell which of them to load into memory first.
+'''
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    meta TEXT NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+CREATE TABLE IF NOT EXISTS vary (url TEXT PRIMARY KEY, names TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL);
+INSERT OR IGNORE INTO totals VALUES (0, 0);
+'''
+
+# Eviction order of each policy, first rows go first
+POLICIES = {
+    'lru': 'last_access',
+    'lfu': 'hits, last_access',
+}
+
+# Accesses are written to the index in batches
+ACCESS_FLUSH_COUNT = 256
+ACCESS_FLUSH_INTERVAL = 1.0
+
+
+class CacheStore:
+    '''
+    Sharded, size-bounded response store. Keys are strings, meta is any JSON-serialisable value.
+    '''
+    def __init__(self, directory, max_bytes, policy='lru'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.order = POLICIES[policy]
+        self.objects = os.path.join(directory, 'objects')
+        self.tmp = os.path.join(directory, 'tmp')
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.tmp, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite'), timeout=10)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.accessed = {} # key -> [last access, hits] not yet written to the index
+        self.flushed_at = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def recover(self):
+        '''
+        Startup cleanup: drops downloads a previous run left unfinished and recounts the total size
+        '''
+        for name in os.listdir(self.tmp):
+            try:
+                os.remove(os.path.join(self.tmp, name))
+            except OSError:
+                pass
+        with self.db:
+            self.db.execute('UPDATE totals SET bytes = (SELECT COALESCE(SUM(size), 0) FROM entries)')
+
+    def object_path(self, key):
+        '''
+        New file name for a version of key, two levels of 256 directories keep each directory small
+        '''
+        digest = hashlib.sha256(key.encode('utf-8', 'surrogateescape')).hexdigest()
+        return os.path.join(self.objects, digest[:2], digest[2:4], f"{digest}-{os.urandom(4).hex()}")
+
+    def temp_path(self):
+        '''
+        Where to write a download until it is committed
+        '''
+        return os.path.join(self.tmp, f"{os.getpid()}-{os.urandom(6).hex()}")
+
+    def open(self, key):
+        '''
+        (meta, open binary file) of the entry for key, None on a miss
+        '''
+        row = self.db.execute('SELECT path, meta FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        path, meta = row
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError: # evicted by another process since the lookup
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touch(key)
+        return json.loads(meta), f
+
+    def version(self, key):
+        '''
+        Current version of the entry for key, the path of its file, None when there is none.
+        Every commit writes a new file, so a changed path means the entry was replaced.
+        '''
+        row = self.db.execute('SELECT path FROM entries WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def touch(self, key):
+        '''
+        Records an access to key for the eviction policy, also for hits served from memory
+        '''
+        access = self.accessed.setdefault(key, [0.0, 0])
+        access[0] = time.time()
+        access[1] += 1
+        if len(self.accessed) >= ACCESS_FLUSH_COUNT or time.monotonic() - self.flushed_at > ACCESS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the batched accesses to the index
+        '''
+        if self.accessed:
+            with self.db:
+                self.db.executemany('UPDATE entries SET last_access = ?, hits = hits + ? WHERE key = ?',
+                                    [(at, hits, key) for key, (at, hits) in self.accessed.items()])
+            self.accessed.clear()
+        self.flushed_at = time.monotonic()
+
+    def commit(self, key, temp_path, size, meta):
+        '''
+        Moves a finished download into the store under key, replacing what was there.
+        Returns False (and drops the file) when it is bigger than the whole budget.
+        '''
+        if size > self.max_bytes:
+            self.discard(temp_path)
+            return False
+        path = self.object_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        with self.db:
+            old = self.db.execute('SELECT path, size FROM entries WHERE key = ?', (key,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO entries (key, path, size, meta, last_access, hits) '
+                            'VALUES (?, ?, ?, ?, ?, 0)', (key, path, size, json.dumps(meta), time.time()))
+            self.db.execute('UPDATE totals SET bytes = bytes + ?', (size - (old[1] if old else 0),))
+        if old:
+            remove_file(old[0])
+        self.evict()
+        return True
+
+    def update(self, key, meta):
+        '''
+        Replaces the metadata of an entry, after a revalidation
+        '''
+        with self.db:
+            self.db.execute('UPDATE entries SET meta = ? WHERE key = ?', (json.dumps(meta), key))
+
+    def invalidate(self, url):
+        '''
+        Drops every stored variant of url, after a request that changed it
+        '''
+        prefix = url + '~'
+        with self.db:
+            rows = self.db.execute('DELETE FROM entries WHERE key = ? OR substr(key, 1, ?) = ? RETURNING path, size',
+                                   (url, len(prefix), prefix)).fetchall()
+            self.db.execute('UPDATE totals SET bytes = bytes - ?', (sum(size for _, size in rows),))
+            self.db.execute('DELETE FROM vary WHERE url = ?', (url,))
+        for path, _ in rows:
+            remove_file(path)
+
+    def discard(self, temp_path):
+        remove_file(temp_path)
+
+    def evict(self):
+        '''
+        Removes entries in policy order until the store fits its budget
+        '''
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        self.flush()
+        victims = []
+        for key, path, size in self.db.execute(f'SELECT key, path, size FROM entries ORDER BY {self.order}'):
+            if total <= self.max_bytes:
+                break
+            victims.append((key, path))
+            total -= size
+        with self.db:
+            for key, path in victims:
+                row = self.db.execute('DELETE FROM entries WHERE key = ? AND path = ? RETURNING size',
+                                      (key, path)).fetchone()
+                if row:
+                    self.db.execute('UPDATE totals SET bytes = bytes - ?', row)
+        for _, path in victims:
+            remove_file(path)
+        self.evictions += len(victims)
+
+    def vary(self, url):
+        '''
+        Request header names the responses for url vary on
+        '''
+        row = self.db.execute('SELECT names FROM vary WHERE url = ?', (url,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def set_vary(self, url, names):
+        with self.db:
+            if names:
+                self.db.execute('INSERT OR REPLACE INTO vary VALUES (?, ?)', (url, json.dumps(names)))
+            else:
+                self.db.execute('DELETE FROM vary WHERE url = ?', (url,))
+
+    def hottest(self, limit):
+        '''
+        (key, path, size, meta) of the most used entries, most hits first
+        '''
+        self.flush()
+        rows = self.db.execute('SELECT key, path, size, meta FROM entries ORDER BY hits DESC, last_access DESC LIMIT ?',
+                               (limit,))
+        return [(key, path, size, json.loads(meta)) for key, path, size, meta in rows]
+
+    def total_bytes(self):
+        return self.db.execute('SELECT bytes FROM totals').fetchone()[0]
+
+    def stats(self):
+        entries = self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': hit_ratio(self.hits, self.misses),
+                'evictions': self.evictions, 'entries': entries, 'bytes': self.total_bytes()}
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class MemoryCache:
+    '''
+    Byte-budgeted LRU of response bodies in memory. Urls are the unit of recency and eviction,
+    each holds the Vary names of the url and its variants as {key: (meta, body, version)}, where version
+    is the CacheStore.version the body was read from.
+    '''
+    def __init__(self, max_bytes, max_object_bytes):
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.urls = OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def vary(self, url):
+        '''
+        Vary names of url, None when none of its responses are held
+        '''
+        held = self.urls.get(url)
+        return None if held is None else held[0]
+
+    def get(self, url, key):
+        '''
+        (meta, body, version) of the variant key of url, None on a miss
+        '''
+        held = self.urls.get(url)
+        variant = held[1].get(key) if held is not None else None
+        if variant is None:
+            self.misses += 1
+            return None
+        self.urls.move_to_end(url)
+        self.hits += 1
+        return variant
+
+    def accepts(self, size):
+        '''
+        Whether a body of this size is worth keeping in memory
+        '''
+        return size <= self.max_object_bytes and size <= self.max_bytes
+
+    def put(self, url, names, key, meta, body, version):
+        '''
+        Adds a variant, evicting least recently used urls until it fits in the budget
+        '''
+        held = self.urls.get(url)
+        if held is None or held[0] != names:
+            self.remove(url)
+            held = self.urls[url] = (names, {})
+        old = held[1].get(key)
+        if old is not None:
+            self.used -= len(old[1])
+        held[1][key] = (meta, body, version)
+        self.used += len(body)
+        self.urls.move_to_end(url)
+        while self.used > self.max_bytes and next(iter(self.urls)) != url:
+            self.evictions += 1
+            self.remove(next(iter(self.urls)))
+
+    def update(self, url, key, meta):
+        '''
+        Replaces the metadata of a held variant, after a revalidation
+        '''
+        held = self.urls.get(url)
+        if held is not None and key in held[1]:
+            held[1][key] = (meta, *held[1][key][1:])
+
+    def remove(self, url):
+        held = self.urls.pop(url, None)
+        if held is not None:
+            self.used -= sum(len(body) for _, body, _ in held[1].values())
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': hit_ratio(self.hits, self.misses),
+                'evictions': self.evictions, 'entries': len(self.urls), 'bytes': self.used}
+
+
+def hit_ratio(hits, misses):
+    return round(hits / (hits + misses), 4) if hits + misses else 0
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
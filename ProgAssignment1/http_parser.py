@@ -0,0 +1,175 @@
+'''
+Incremental HTTP/1.x request parser shared by webserver.py and proxyserver.py.
+Bytes are fed in as they arrive and complete requests are pulled out one at a time,
+so split packets, large headers and pipelined requests are all handled the same way.
+'''
+import re
+import time
+
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 16 * 1024 * 1024
+RECV_SIZE = 64 * 1024
+
+# End of the request head, bare LF line endings are accepted as well as CRLF
+HEAD_END = re.compile(rb"\r?\n\r?\n")
+LINE_END = re.compile(r"\r?\n")
+
+
+class HttpParseError(Exception):
+    '''
+    Raised for a request that can't be parsed, status is the HTTP status to answer with
+    '''
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+class HttpRequest:
+    '''
+    One parsed request. Header names are lowercase, body is b"" when there is none.
+    started is the perf_counter() time its first byte arrived.
+    '''
+    __slots__ = ('method', 'path', 'version', 'headers', 'body', 'started')
+
+    def __init__(self, method, path, version, headers, body=b"", started=None):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.started = started
+
+    @property
+    def request_line(self):
+        return f"{self.method} {self.path} {self.version}"
+
+    @property
+    def keep_alive(self):
+        '''
+        HTTP/1.1 connections stay open unless the client says close, HTTP/1.0 ones only when asked to
+        '''
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+
+class RequestParser:
+    '''
+    Buffers the bytes of one connection and splits them into requests
+    '''
+    def __init__(self, max_header_bytes=MAX_HEADER_BYTES, max_body_bytes=MAX_BODY_BYTES):
+        self.buffer = bytearray()
+        self.max_header_bytes = max_header_bytes
+        self.max_body_bytes = max_body_bytes
+        self.scanned = 0 # bytes already searched for the end of the head
+        self.pending = None # parsed head still waiting for its body
+        self.started = None # perf_counter() when the first byte of the current request arrived
+
+    def feed(self, data):
+        if not self.buffer:
+            self.started = time.perf_counter()
+        self.buffer += data
+
+    def next_request(self):
+        '''
+        Returns the next complete request or None if more bytes are needed
+        '''
+        if self.pending is None:
+            match = HEAD_END.search(self.buffer, max(0, self.scanned - 3))
+            if match is None:
+                self.scanned = len(self.buffer)
+                if self.scanned > self.max_header_bytes:
+                    raise HttpParseError(431, "Request Header Fields Too Large")
+                return None
+            if match.start() > self.max_header_bytes:
+                raise HttpParseError(431, "Request Header Fields Too Large")
+            head = self.buffer[:match.start()].decode('latin-1')
+            del self.buffer[:match.end()]
+            self.scanned = 0
+            self.pending = parse_head(head)
+            self.pending.started = self.started
+            length = content_length(self.pending.headers)
+            if length > self.max_body_bytes:
+                raise HttpParseError(413, "Payload Too Large")
+
+        request = self.pending
+        length = content_length(request.headers)
+        if len(self.buffer) < length:
+            return None
+        if length:
+            request.body = bytes(self.buffer[:length])
+            del self.buffer[:length]
+        self.pending = None
+        if self.buffer: # a pipelined request is already waiting
+            self.started = time.perf_counter()
+        return request
+
+
+def parse_head(head):
+    '''
+    Parses the request line and headers of a request head (without the blank line)
+    '''
+    lines = LINE_END.split(head.lstrip('\r\n'))
+    parts = lines[0].split()
+    if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        raise HttpParseError(400, "Bad Request")
+    method, path, version = parts
+
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise HttpParseError(400, "Bad Request")
+        headers[name.strip().lower()] = value.strip()
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        raise HttpParseError(411, "Length Required")
+    return HttpRequest(method, path, version, headers)
+
+
+def content_length(headers):
+    value = headers.get('content-length')
+    if value is None:
+        return 0
+    if not value.isdigit():
+        raise HttpParseError(400, "Bad Request")
+    return int(value)
+
+
+def read_request(sock, parser):
+    '''
+    Reads from a blocking socket until the parser has a whole request.
+    Returns None when the client closed the connection first.
+    '''
+    while True:
+        request = parser.next_request()
+        if request is not None:
+            return request
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            return None
+        parser.feed(data)
+
+
+async def read_request_async(reader, parser):
+    '''
+    asyncio version of read_request for StreamReader connections
+    '''
+    while True:
+        request = parser.next_request()
+        if request is not None:
+            return request
+        data = await reader.read(RECV_SIZE)
+        if not data:
+            return None
+        parser.feed(data)
+
+
+def error_response(error):
+    '''
+    Complete response for a HttpParseError, the connection should be closed after it
+    '''
+    content = b"<html><body><h1>%d %s</h1></body></html>" % (error.status, error.reason.encode())
+    return b"HTTP/1.1 %d %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s" % (
+        error.status, error.reason.encode(), len(content), content)
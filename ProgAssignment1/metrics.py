@@ -0,0 +1,149 @@
+'''
+Per-request timing for webserver.py and proxyserver.py.
+Stage timings go into fixed-bucket histograms that are rendered in the Prometheus text format
+for the /__metrics endpoint, and a sampled access log replaces printing every request.
+'''
+import random
+import sys
+import threading
+import time
+from bisect import bisect_left
+from multiprocessing.sharedctypes import RawArray
+
+METRICS_PATH = '/__metrics'
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    '''
+    Stage histograms and counters kept in shared memory with one slot per worker process,
+    so whichever worker answers /__metrics reports the totals of all of them.
+    Each process only writes its own slot, the lock only guards threads of that process.
+    '''
+    def __init__(self, prefix, stages, counters, slots=1):
+        self.prefix = prefix
+        self.stages = stages
+        self.counter_names = counters
+        self.slots = slots
+        # Per slot: one count per bucket, one for +Inf, then the sum
+        self.width = len(BUCKETS) + 2
+        self.histograms = {stage: RawArray('d', slots * self.width) for stage in stages}
+        self.counters = {name: RawArray('d', slots) for name in counters}
+        self.slot = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        values = self.histograms[stage]
+        base = self.slot * self.width
+        with self.lock:
+            values[base + bisect_left(BUCKETS, seconds)] += 1
+            values[base + self.width - 1] += seconds
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name][self.slot] += amount
+
+    def render(self, gauges=None):
+        '''
+        Prometheus text exposition of everything recorded so far.
+        gauges is an optional {name: value} of values owned by the answering process.
+        '''
+        name = f"{self.prefix}_request_stage_seconds"
+        lines = [f"# HELP {name} Time spent in each stage of a request",
+                 f"# TYPE {name} histogram"]
+        for stage in self.stages:
+            values = self.histograms[stage]
+            totals = [sum(values[slot * self.width + i] for slot in range(self.slots)) for i in range(self.width)]
+            cumulative = 0
+            for bound, count in zip(BUCKETS, totals):
+                cumulative += count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative:.0f}')
+            cumulative += totals[len(BUCKETS)]
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {cumulative:.0f}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {totals[-1]:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {cumulative:.0f}')
+
+        for counter in self.counter_names:
+            lines.append(f"# TYPE {self.prefix}_{counter} counter")
+            lines.append(f"{self.prefix}_{counter} {sum(self.counters[counter]):.0f}")
+        typed = set()
+        for gauge, value in (gauges or {}).items():
+            family = gauge.split('{', 1)[0]
+            if family not in typed:
+                typed.add(family)
+                lines.append(f"# TYPE {self.prefix}_{family} gauge")
+            lines.append(f"{self.prefix}_{gauge} {value}")
+        return ("\n".join(lines) + "\n").encode()
+
+    def response(self, gauges=None, keep_alive=False):
+        '''
+        Complete HTTP response for a scrape of the metrics endpoint
+        '''
+        body = self.render(gauges)
+        return (b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n"
+                b"Connection: %s\r\n\r\n%s" % (len(body), b"keep-alive" if keep_alive else b"close", body))
+
+
+class RequestTimer:
+    '''
+    Times the stages of one request, each mark() records the time since the previous one
+    '''
+    __slots__ = ('metrics', 'start', 'last')
+
+    def __init__(self, metrics, start=None):
+        self.metrics = metrics
+        self.start = self.last = start if start is not None else time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.metrics.observe(stage, now - self.last)
+        self.last = now
+
+    def finish(self):
+        '''
+        Records the total time of the request and returns it
+        '''
+        total = time.perf_counter() - self.start
+        self.metrics.observe('total', total)
+        return total
+
+
+def is_local(addr):
+    '''
+    The metrics endpoint only answers clients on this machine
+    '''
+    return bool(addr) and addr[0] in ('127.0.0.1', '::1', '::ffff:127.0.0.1')
+
+
+class AccessLog:
+    '''
+    Writes a sample of requests to a file ("-" for stdout), disabled when path is None
+    '''
+    def __init__(self, path=None, sample=1.0):
+        self.sample = sample
+        self.lock = threading.Lock()
+        if path is None:
+            self.file = None
+        elif path == '-':
+            self.file = sys.stdout
+        else:
+            self.file = open(path, 'a', buffering=1)
+
+    def log(self, addr, request_line, status, sent, seconds):
+        if self.file is None or (self.sample < 1.0 and random.random() >= self.sample):
+            return
+        host = addr[0] if addr else '-'
+        line = f'{host} [{time.strftime("%d/%b/%Y:%H:%M:%S %z")}] "{request_line}" {status} {sent} {seconds * 1000:.3f}ms\n'
+        with self.lock:
+            self.file.write(line)
@@ -0,0 +1,263 @@
+'''
+HTTP caching rules for proxyserver.py, as a shared cache in the sense of RFC 9111.
+Decides which origin responses may be stored, how long a stored response stays fresh,
+which stored variant answers a request (Vary), and how a stale one is revalidated.
+'''
+import hashlib
+import time
+from email.utils import parsedate_to_datetime
+
+# Only these are kept, errors and 404s are always fetched again
+CACHEABLE_STATUS = frozenset((200, 203, 300, 301, 308))
+
+# Without explicit freshness a response with Last-Modified stays fresh for a fraction of its age
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX = 24 * 60 * 60
+
+# Headers that belong to one connection and are never passed on
+HOP_BY_HOP = frozenset(('connection', 'keep-alive', 'proxy-connection', 'te', 'trailer', 'transfer-encoding',
+                        'upgrade', 'proxy-authorization', 'proxy-authenticate'))
+# The client's own conditions are not forwarded, the cache wants complete responses to store
+CLIENT_CONDITIONS = frozenset(('if-none-match', 'if-modified-since', 'if-match', 'if-unmodified-since',
+                               'if-range', 'range'))
+# Headers of a 304 that must not replace the stored ones
+NOT_UPDATED = frozenset(('content-length', 'content-encoding', 'content-range', 'transfer-encoding'))
+
+
+def parse_head(head):
+    '''
+    Status code and headers (lowercase names) of a response head, repeated headers are joined with ", "
+    '''
+    lines = head.split('\r\n')
+    try:
+        status = int(lines[0].split()[1])
+    except (IndexError, ValueError):
+        status = 0
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if not sep:
+            continue
+        name = name.strip().lower()
+        value = value.strip()
+        headers[name] = f"{headers[name]}, {value}" if name in headers else value
+    return status, headers
+
+
+def cache_control(headers):
+    '''
+    Cache-Control directives as {name: value}, directives without a value map to True
+    '''
+    directives = {}
+    for part in headers.get('cache-control', '').split(','):
+        name, sep, value = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip().strip('"') if sep else True
+    if 'no-cache' in headers.get('pragma', '').lower() and 'cache-control' not in headers:
+        directives['no-cache'] = True
+    return directives
+
+
+def seconds(directives, name):
+    '''
+    Integer value of a delta-seconds directive, None when absent or malformed
+    '''
+    value = directives.get(name)
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return None
+
+
+def http_date(value):
+    '''
+    Epoch seconds of an HTTP date, None when missing or invalid
+    '''
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def vary_names(headers):
+    '''
+    Request header names the response varies on
+    '''
+    return sorted({name.strip().lower() for name in headers.get('vary', '').split(',') if name.strip()})
+
+
+def vary_key(names, request_headers):
+    '''
+    Suffix that tells the stored variants of one url apart, '' when the response doesn't vary
+    '''
+    if not names:
+        return ''
+    selected = '\n'.join(f"{name}:{request_headers.get(name, '')}" for name in names)
+    return hashlib.sha1(selected.encode('latin-1', 'replace')).hexdigest()[:16]
+
+
+def storable(status, headers, request_headers):
+    '''
+    Whether a response to a GET may be kept by a shared cache
+    '''
+    if status not in CACHEABLE_STATUS:
+        return False
+    response_cc = cache_control(headers)
+    request_cc = cache_control(request_headers)
+    if 'no-store' in response_cc or 'no-store' in request_cc or 'private' in response_cc:
+        return False
+    if '*' in vary_names(headers):
+        return False
+    if 'authorization' in request_headers and not (
+            'public' in response_cc or 's-maxage' in response_cc or 'must-revalidate' in response_cc):
+        return False
+    # Nothing to gain from a copy that is never fresh and can't be revalidated
+    return freshness_lifetime(headers, time.time()) > 0 or 'etag' in headers or 'last-modified' in headers
+
+
+def freshness_lifetime(headers, response_time):
+    '''
+    Seconds a response stays fresh: s-maxage, then max-age, then Expires, then the Last-Modified heuristic
+    '''
+    directives = cache_control(headers)
+    for name in ('s-maxage', 'max-age'):
+        value = seconds(directives, name)
+        if value is not None:
+            return value
+    date = http_date(headers.get('date')) or response_time
+    if 'expires' in headers:
+        expires = http_date(headers['expires'])
+        return max(0, expires - date) if expires is not None else 0
+    last_modified = http_date(headers.get('last-modified'))
+    if last_modified is not None and last_modified < date:
+        return min(HEURISTIC_MAX, (date - last_modified) * HEURISTIC_FRACTION)
+    return 0
+
+
+def forward_headers(request_headers, conditions=False):
+    '''
+    The client's headers that go on to the origin, without hop-by-hop headers, and without
+    conditions unless the response doesn't go through the cache
+    '''
+    dropped = HOP_BY_HOP | {'host'}
+    if not conditions:
+        dropped |= CLIENT_CONDITIONS
+    dropped |= {name.strip().lower() for name in request_headers.get('connection', '').split(',')}
+    return {name: value for name, value in request_headers.items() if name not in dropped}
+
+
+def relay_head(head):
+    '''
+    Response head as passed on to clients: without hop-by-hop headers, as the body is sent decoded
+    and the connection closes after it
+    '''
+    lines = head.split('\r\n')
+    headers = parse_head(head)[1]
+    dropped = HOP_BY_HOP | {name.strip().lower() for name in headers.get('connection', '').split(',')}
+    kept = [line for line in lines[1:] if line.partition(':')[0].strip().lower() not in dropped]
+    return '\r\n'.join([lines[0]] + kept + ['Connection: close'])
+
+
+def update_head(head, new_head):
+    '''
+    Stored head with the headers of a 304 head replacing the ones of the same name
+    '''
+    updates = [line for line in new_head.split('\r\n')[1:]
+               if ':' in line and line.partition(':')[0].strip().lower() not in NOT_UPDATED | HOP_BY_HOP]
+    names = {line.partition(':')[0].strip().lower() for line in updates}
+    lines = [line for line in head.split('\r\n') if line.partition(':')[0].strip().lower() not in names]
+    return '\r\n'.join(lines + updates)
+
+
+class Entry:
+    '''
+    What is kept next to a stored response: its head, where the body starts, the request headers
+    it varies on and what is needed to work out its age and freshness
+    '''
+    FIELDS = ('status', 'head', 'head_length', 'size', 'request_time', 'response_time', 'date', 'age_value',
+              'lifetime', 'no_cache', 'vary')
+
+    def __init__(self, status, head, head_length, request_headers, request_time, response_time):
+        self.status = status
+        self.head_length = head_length
+        self.size = 0
+        self.refresh(head, request_time, response_time)
+        headers = parse_head(head)[1]
+        self.vary = {name: request_headers.get(name, '') for name in vary_names(headers)}
+
+    def refresh(self, head, request_time, response_time):
+        '''
+        Takes the timing and freshness of a new or revalidated head
+        '''
+        self.head = head
+        self.request_time = request_time
+        self.response_time = response_time
+        headers = parse_head(head)[1]
+        directives = cache_control(headers)
+        self.date = http_date(headers.get('date')) or response_time
+        age = headers.get('age', '')
+        self.age_value = int(age) if age.isdigit() else 0
+        self.lifetime = freshness_lifetime(headers, response_time)
+        self.no_cache = 'no-cache' in directives
+
+    @property
+    def headers(self):
+        return parse_head(self.head)[1]
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, values):
+        entry = cls.__new__(cls)
+        for name in cls.FIELDS:
+            setattr(entry, name, values[name])
+        return entry
+
+    def age(self, now):
+        '''
+        Current age in seconds (RFC 9111 section 4.2.3)
+        '''
+        apparent_age = max(0, self.response_time - self.date)
+        corrected_age = self.age_value + (self.response_time - self.request_time)
+        return max(apparent_age, corrected_age) + (now - self.response_time)
+
+    def fresh(self, now, request_headers):
+        '''
+        Whether it can be served without asking the origin, the client may ask for a younger copy
+        '''
+        directives = cache_control(request_headers)
+        if self.no_cache or 'no-cache' in directives:
+            return False
+        age = self.age(now)
+        max_age = seconds(directives, 'max-age')
+        if max_age is not None and age > max_age:
+            return False
+        return age < self.lifetime
+
+    def matches(self, request_headers):
+        '''
+        Whether this variant answers a request with these headers
+        '''
+        return all(request_headers.get(name, '') == value for name, value in self.vary.items())
+
+    def conditions(self):
+        '''
+        Headers that turn the refetch of a stale copy into a revalidation
+        '''
+        headers = self.headers
+        conditions = {}
+        if 'etag' in headers:
+            conditions['If-None-Match'] = headers['etag']
+        if 'last-modified' in headers:
+            conditions['If-Modified-Since'] = headers['last-modified']
+        return conditions
+
+    def response_head(self, now):
+        '''
+        Head to send for a hit, with the current Age
+        '''
+        lines = [line for line in self.head.split('\r\n') if line.partition(':')[0].strip().lower() != 'age']
+        lines.append(f"Age: {int(self.age(now))}")
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
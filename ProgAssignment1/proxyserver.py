@@ -1,85 +1,643 @@
-from socket import *
-import os
-
-# Creating a server socket
-server_socket = socket(AF_INET, SOCK_STREAM)
-server_port = 8888
-server_socket.bind(('', server_port))
-server_socket.listen(5)
-
-# Cache Creation
-cache_directory = 'web_cache'
-if not os.path.exists(cache_directory):
-    os.makedirs(cache_directory)
-
-# parses the request and returns the host and path.
-def parse_request(url):
-    if url.startswith("http://"):
-        url = url[7:]
-
-    host_path_split = url.split("/", 1)
-    hostn = host_path_split[0]
-    if len(host_path_split) > 1:
-        path = "/" + host_path_split[1]  
-    else:
-        path = "/"
-
-    return hostn, path
-
-# Function to generate a valid file name for caching
-def get_cache_file_name(url):
-    return os.path.join(cache_directory, url.replace('/', '_'))
-
-while True:
-    # Accepting the connection
-    print('Serving')
-    client_socket, addr = server_socket.accept()
-    print('Got connection from:', addr)
-
-    message = client_socket.recv(1024).decode('utf-8')
-    print(message)
-
-    # Parsing the request
-    first_line = message.split('\n')[0]
-    url = first_line.split()[1][1:]
-
-    hostname, path = parse_request(url)
-    cache_file = get_cache_file_name(hostname + path)
-
-    print("Host:", hostname)
-    print("Path:", path)
-
-    connection_sock = None
-    try:
-        # Cache Checking
-        if os.path.isfile(cache_file):
-            print("Serving from cache")
-            with open(cache_file, 'rb') as f: # if in cache then use it
-                client_socket.send(f.read())
-        else:
-            # If not in cache then connect to the server and get the response
-            connection_sock = socket(AF_INET, SOCK_STREAM)
-            connection_sock.connect((gethostbyname(hostname), 80))
-            request = f"GET {path} HTTP/1.0\r\nHost: {hostname}\r\n\r\n"
-            connection_sock.send(request.encode())
-
-            # Writing to cache
-            with open(cache_file, 'wb') as to_cache:
-                response = connection_sock.recv(4096)
-                while len(response) > 0:
-                    client_socket.send(response)
-                    to_cache.write(response)
-                    response = connection_sock.recv(4096)
-    # Exception Handling
-    except Exception as e:
-        print("Exception:", e)
-        client_socket.send(b"HTTP/1.0 404 Not Found\r\n")
-        client_socket.send(b"Content-Type:text/html\r\n")
-        client_socket.send(b"\r\n")
-    finally:
-        if connection_sock:
-            connection_sock.close()
-        client_socket.close()
-
-# Closing the server socket
-server_socket.close()
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from cache_store import POLICIES, CacheStore, MemoryCache
+from http_parser import HttpParseError, RequestParser, error_response, read_request_async
+from metrics import METRICS_PATH, AccessLog, Metrics, RequestTimer, is_local
+from proxy_cache import Entry, forward_headers, parse_head, relay_head, storable, update_head, vary_key, vary_names
+from resolver import Resolver
+from tunnel import Tunnel
+from upstream import CHUNKED, ConnectionPool, body_length, keeps_alive, read_body
+
+server_port = 8888
+server_backlog = 1024
+cache_directory = 'web_cache'
+cache_bytes = 1024 * 1024 * 1024 # disk budget of the cache
+cache_policy = 'lru'
+cache_store = None # opened by apply_args, every process has its own
+shared_store = False # whether other processes (the workers of --workers) use the same cache directory
+memory_bytes = 64 * 1024 * 1024 # budget of the in-memory tier in front of the disk cache
+memory_max_object = 1024 * 1024 # larger responses are always sent from disk with sendfile
+memory_cache = MemoryCache(memory_bytes, memory_max_object)
+upstream_buffer = 256 * 1024 # receive buffer of each origin connection, filled with recv_into and reused
+upstream_timeout = 30 # seconds to wait on a silent origin
+upstream_max_per_host = 8 # connections open to one origin at once
+upstream_idle_timeout = 15 # seconds an unused origin connection is kept open
+warm_entries = 4096 # most used disk entries considered for the memory tier at startup
+hot_urls = 1000 # urls of the most used entries written to hot_urls.txt in the cache directory on shutdown
+dns_ttl = 60 # seconds a resolved origin name is reused
+dns_negative_ttl = 5 # seconds a name that failed to resolve keeps failing without a new query
+upstream_pool = ConnectionPool(upstream_max_per_host, upstream_idle_timeout, upstream_timeout,
+                               Resolver(dns_ttl, dns_negative_ttl), upstream_buffer)
+
+# Request timings served on /__metrics, and the sampled access log
+metric_stages = ('parse', 'cache_lookup', 'upstream_connect', 'first_byte', 'total')
+metric_counters = ('connections_total', 'requests_total', 'cache_hits_total', 'cache_misses_total',
+                   'cache_revalidated_total', 'coalesced_total', 'tunnels_total', 'errors_total',
+                   'bytes_sent_total')
+metrics = Metrics('proxy', metric_stages, metric_counters)
+access_log = AccessLog()
+
+# Origin fetches in progress by url, so concurrent misses for one url share a single download
+in_flight = {}
+fetches = set() # running fetch tasks, the event loop only keeps weak references
+
+
+# parses the request and returns the host and path.
+def parse_request(url):
+    if url.startswith("http://"):
+        url = url[7:]
+
+    host_path_split = url.split("/", 1)
+    hostn = host_path_split[0]
+    if len(host_path_split) > 1:
+        path = "/" + host_path_split[1]
+    else:
+        path = "/"
+
+    # An explicit port has to be one, anything else is answered with 400
+    port = hostn.partition(':')[2]
+    if port and port_number(port) is None:
+        raise HttpParseError(400, "Bad Request")
+    return hostn, path
+
+# Number of a TCP port from its text, None unless it is a number from 1 to 65535
+def port_number(text):
+    if not (text.isascii() and text.isdigit()):
+        return None
+    port = int(text)
+    return port if 0 < port < 65536 else None
+
+# Cache key of the variant of url selected by the given Vary names
+def variant_key(url, names, request_headers):
+    key = vary_key(names, request_headers)
+    return f"{url}~{key}" if key else url
+
+# Finds the stored response for a request, memory first and then disk. Returns its key, its Entry and
+# its body as bytes from memory or as the open file on disk (both None on a miss).
+# Small responses found on disk are moved up into memory for the next request.
+# With --workers another process may have invalidated or replaced what memory holds, so there a memory hit only
+# counts while the index still has the same version, and otherwise the url is looked up again from disk.
+# A single process changes both tiers together and serves memory hits without touching the index.
+def lookup(url, request_headers):
+    names = memory_cache.vary(url)
+    if names is None:
+        names = cache_store.vary(url)
+    key = variant_key(url, names, request_headers)
+    found = memory_cache.get(url, key)
+    if found is not None:
+        meta, body, version = found
+        if shared_store and cache_store.version(key) != version:
+            memory_cache.remove(url)
+            return lookup(url, request_headers)
+        cache_store.touch(key)
+        entry = Entry.from_dict(meta)
+        return (key, entry, body) if entry.matches(request_headers) else (key, None, None)
+
+    found = cache_store.open(key)
+    if found is None:
+        return key, None, None
+    meta, cached = found
+    entry = Entry.from_dict(meta)
+    if not entry.matches(request_headers):
+        cached.close()
+        return key, None, None
+    if memory_cache.accepts(entry.size - entry.head_length):
+        with cached:
+            cached.seek(entry.head_length)
+            body = cached.read()
+        memory_cache.put(url, names, key, meta, body, cached.name)
+        return key, entry, body
+    return key, entry, cached
+
+# One origin fetch that any number of clients can stream from while it is still arriving.
+# The response goes to a temporary file that is committed to the cache once complete and only if it may be stored.
+# With a stale entry (and its open file) it is a revalidation instead.
+class Download:
+    def __init__(self, url, request_headers, stale=None, stale_key=None, stale_file=None):
+        self.url = url
+        self.request_headers = request_headers
+        self.stale = stale
+        self.stale_key = stale_key
+        self.stale_file = stale_file
+        self.part_file = cache_store.temp_path()
+        self.file = open(self.part_file, 'wb', buffering=0) # unbuffered, clients read what was written right away
+        self.key = None
+        self.entry = None # set once the head shows the response can be stored
+        self.size = 0 # bytes written so far
+        self.status = 0
+        self.not_modified = False
+        self.done = False
+        self.error = None
+        loop = asyncio.get_running_loop()
+        self.head_ready = loop.create_future()
+        self.changed = loop.create_future()
+
+    # Wakes every client waiting for more bytes
+    def publish(self):
+        self.changed.set_result(None)
+        self.changed = asyncio.get_running_loop().create_future()
+
+    # Waits until there are bytes past offset or the download is over
+    async def wait(self, offset):
+        while self.size <= offset and not self.done:
+            await self.changed
+
+    # Whether a client that joins with these headers may get this response, as it could from the cache.
+    # A 304 only refreshes the copy the revalidating client has open, others revalidate for themselves.
+    def shared_with(self, request_headers):
+        if self.error is not None:
+            return True
+        return not self.not_modified and self.entry is not None and self.entry.matches(request_headers)
+
+# Fetches url from the origin into the download, independent of any one client.
+# However it ends, the temporary file is closed and removed unless it was committed, and waiting clients are woken,
+# with download.error set when it failed.
+async def fetch(download, hostname, path):
+    timer = RequestTimer(metrics)
+    connection = None
+    stored = False
+    try:
+        host, _, port = hostname.partition(':')
+        headers = forward_headers(download.request_headers)
+        if download.stale is not None:
+            headers.update(download.stale.conditions())
+        lines = [f"GET {path} HTTP/1.1", f"Host: {hostname}"] + [f"{name}: {value}" for name, value in headers.items()]
+        request_time = time.time()
+        connection, head = await upstream_pool.request(host, int(port or 80),
+                                                       ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'),
+                                                       upstream_timeout, lambda: timer.mark('upstream_connect'))
+        timer.mark('first_byte')
+        response_time = time.time()
+        text = head[:-4].decode('latin-1')
+        download.status, headers = parse_head(text)
+        length = body_length(download.status, headers)
+        reusable = keeps_alive(head, headers, length)
+
+        # Revalidated, the stored copy is good for another while
+        if download.status == 304 and download.stale is not None:
+            upstream_pool.release(connection, reusable)
+            connection = None
+            download.stale.refresh(update_head(download.stale.head, text), request_time, response_time)
+            cache_store.update(download.stale_key, download.stale.to_dict())
+            memory_cache.update(download.url, download.stale_key, download.stale.to_dict())
+            download.not_modified = True
+            return
+
+        text = relay_head(text)
+        head = (text + "\r\n\r\n").encode('latin-1')
+        if storable(download.status, headers, download.request_headers):
+            download.entry = Entry(download.status, text, len(head), download.request_headers,
+                                   request_time, response_time)
+            download.key = variant_key(download.url, vary_names(headers), download.request_headers)
+        download.head_ready.set_result(None)
+
+        # Writing to cache, straight from the connection's buffer. Clients send from the file on their own,
+        # so a slow one never holds up the download and one that leaves doesn't stop it.
+        with download.file as to_cache:
+            write_all(to_cache, head)
+            download.size = len(head)
+            download.publish()
+            async for view in read_body(connection, length, upstream_timeout):
+                write_all(to_cache, view)
+                download.size += len(view)
+                download.publish()
+        upstream_pool.release(connection, reusable)
+        connection = None
+
+        if download.entry is not None:
+            download.entry.size = download.size
+            if length == CHUNKED: # stored copies are sent with their length
+                download.entry.head += f"\r\nContent-Length: {download.size - len(head)}"
+            memory_cache.remove(download.url) # held variants may be older or vary differently
+            stored = cache_store.commit(download.key, download.part_file, download.size, download.entry.to_dict())
+            if stored:
+                cache_store.set_vary(download.url, sorted(download.entry.vary))
+    # Exception Handling, besides the origin's failures this is also a sqlite3.Error from the index or a bug
+    except Exception as e:
+        print("Exception:", e)
+        metrics.count('errors_total')
+        download.error = e
+    except asyncio.CancelledError as e: # the proxy is shutting down
+        download.error = e
+        raise
+    finally:
+        download.file.close()
+        if not stored:
+            cache_store.discard(download.part_file)
+        if connection is not None: # the rest of its response was never read
+            upstream_pool.discard(connection)
+        download.done = True
+        if in_flight.get(download.url) is download:
+            del in_flight[download.url]
+        if not download.head_ready.done():
+            download.head_ready.set_result(None)
+        download.publish()
+
+# An unbuffered file can write less than it was given
+def write_all(f, data):
+    written = f.write(data)
+    while written < len(data):
+        written += f.write(data[written:])
+
+# Starts fetching a url, only the first download of a url is found by clients arriving later
+def start_download(url, hostname, path, request_headers, stale, stale_key, stale_file):
+    download = Download(url, request_headers, stale, stale_key, stale_file)
+    in_flight.setdefault(url, download)
+    task = asyncio.create_task(fetch(download, hostname, path))
+    fetches.add(task)
+    task.add_done_callback(fetches.discard)
+    return download
+
+# Sends a stored response with the current Age, returns the status code and the bytes sent.
+# cached is the body from memory or the open file on disk.
+async def send_cached(client_writer, cached, entry):
+    head = entry.response_head(time.time())
+    client_writer.write(head)
+    if isinstance(cached, bytes):
+        client_writer.write(cached)
+        await client_writer.drain()
+        return entry.status, len(head) + len(cached)
+    sent = await send_file(client_writer, cached, entry.head_length)
+    return entry.status, len(head) + sent
+
+# Sends count bytes of a file from offset with sendfile, a client that went away raises ConnectionResetError
+async def send_file(client_writer, f, offset, count=None):
+    if client_writer.transport.is_closing():
+        raise ConnectionResetError("client closed the connection")
+    return await asyncio.get_running_loop().sendfile(client_writer.transport, f, offset, count)
+
+# Streams a download to one client as its bytes arrive, returns the status code and the bytes sent.
+# part is the client's own handle on the temporary file, opened when it attached so the commit can't pull it away.
+async def stream_download(client_writer, download, part):
+    if download.not_modified:
+        metrics.count('cache_revalidated_total')
+        return await send_cached(client_writer, download.stale_file, download.stale)
+
+    sent = 0
+    while True:
+        await download.wait(sent)
+        if download.size > sent:
+            sent += await send_file(client_writer, part, sent, download.size - sent)
+        elif download.done:
+            break
+
+    if download.error is not None and not sent: # too late for an error response once the origin's bytes went out
+        client_writer.write(b"HTTP/1.0 404 Not Found\r\n")
+        client_writer.write(b"Content-Type:text/html\r\n")
+        client_writer.write(b"\r\n")
+        await client_writer.drain()
+        return 404, sent
+    return download.status, sent
+
+# Serves one client connection as a coroutine, so a slow origin only holds up its own client
+async def handle_client(client_reader, client_writer):
+    addr = client_writer.get_extra_info('peername')
+    metrics.count('connections_total')
+    try:
+        # Parsing the request
+        try:
+            parser = RequestParser()
+            request = await read_request_async(client_reader, parser)
+        except HttpParseError as e:
+            client_writer.write(error_response(e))
+            await client_writer.drain()
+            return
+        if request is None:
+            return
+        timer = RequestTimer(metrics, request.started)
+        timer.mark('parse')
+        metrics.count('requests_total')
+
+        # Local clients can read the timings
+        if request.path == METRICS_PATH and is_local(addr):
+            gauges = {}
+            sources = (('memory_cache', memory_cache), ('disk_cache', cache_store), ('upstream', upstream_pool),
+                       ('dns', upstream_pool.resolver))
+            for source_name, source in sources:
+                for stat, value in source.stats().items():
+                    gauges[f'{source_name}_{stat}{{pid="{os.getpid()}"}}'] = value
+            client_writer.write(metrics.response(gauges))
+            await client_writer.drain()
+            return
+        if request.method == 'CONNECT':
+            status, sent = await connect_tunnel(client_reader, client_writer, request, bytes(parser.buffer), timer)
+        else:
+            url = request.path[1:] if request.path.startswith('/') else request.path
+
+            try:
+                hostname, path = parse_request(url)
+            except HttpParseError as e:
+                status, sent = await send_error(client_writer, e.status, e.reason)
+            else:
+                if request.method == 'GET':
+                    status, sent = await serve_url(client_writer, request, hostname, path, timer)
+                else:
+                    status, sent = await pass_through(client_writer, request, hostname, path, timer)
+        metrics.count('bytes_sent_total', sent)
+        access_log.log(addr, request.request_line, status, sent, timer.finish())
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass # client went away
+    finally:
+        client_writer.close()
+
+# Answers from web_cache when there is a fresh copy for the request, otherwise joins or starts
+# the origin fetch for it (a revalidation when the copy is stale). Returns the status code and the bytes sent.
+async def serve_url(client_writer, request, hostname, path, timer):
+    # Cache Checking
+    url = hostname + path
+    key, entry, cached = lookup(url, request.headers)
+    timer.mark('cache_lookup')
+    try:
+        if entry is not None and entry.fresh(time.time(), request.headers): # if in cache then use it
+            metrics.count('cache_hits_total')
+            return await send_cached(client_writer, cached, entry)
+
+        # Another client is already fetching the url, its response is shared when the cache could have served it
+        download = in_flight.get(url)
+        if download is not None:
+            with open(download.part_file, 'rb') as part:
+                await download.head_ready
+                if download.shared_with(request.headers):
+                    metrics.count('coalesced_total')
+                    return await stream_download(client_writer, download, part)
+
+        # If not in cache then fetch it from the origin
+        metrics.count('cache_misses_total')
+        download = start_download(url, hostname, path, request.headers, entry, key, cached)
+        with open(download.part_file, 'rb') as part:
+            await download.head_ready
+            return await stream_download(client_writer, download, part)
+    finally:
+        if cached is not None and not isinstance(cached, bytes):
+            cached.close()
+
+# Key of an index entry back to its url, variant keys carry a suffix after the url
+def key_url(key, meta):
+    return key.rsplit('~', 1)[0] if meta['vary'] else key
+
+# Loads the small responses that were used most before a restart into the memory tier, as many as fit.
+# The hottest are put in last so they are the last to be evicted.
+def warm_memory():
+    chosen = []
+    room = memory_cache.max_bytes - memory_cache.used
+    for key, file_path, size, meta in cache_store.hottest(warm_entries):
+        body_size = size - meta['head_length']
+        if memory_cache.accepts(body_size) and body_size <= room:
+            chosen.append((key, file_path, meta))
+            room -= body_size
+    for key, file_path, meta in reversed(chosen):
+        try:
+            with open(file_path, 'rb') as f:
+                f.seek(meta['head_length'])
+                body = f.read()
+        except FileNotFoundError: # evicted by another process
+            continue
+        memory_cache.put(key_url(key, meta), sorted(meta['vary']), key, meta, body, file_path)
+    return len(chosen)
+
+# Writes the urls of the most used entries to path, hottest first, one per line as --preload reads them
+def export_hot(store, path, limit):
+    urls = dict.fromkeys(key_url(key, meta) for key, _, _, meta in store.hottest(limit))
+    with open(path + '.tmp', 'w') as f:
+        f.writelines(f"http://{url}\n" for url in urls)
+    os.replace(path + '.tmp', path)
+
+# Fetches the urls listed in a file into the cache, concurrency at a time, skipping the ones the cache has fresh.
+# Lines are urls as a client would request them, blank lines and lines starting with # are ignored.
+async def preload(list_path, concurrency):
+    with open(list_path) as f:
+        urls = [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    slots = asyncio.Semaphore(concurrency)
+    outcomes = {'fresh': 0, 'stored': 0, 'not stored': 0, 'failed': 0}
+
+    async def load(url):
+        async with slots:
+            try:
+                hostname, path = parse_request(url)
+            except HttpParseError:
+                outcomes['failed'] += 1
+                return
+            url = hostname + path
+            key, entry, cached = lookup(url, {})
+            try:
+                if entry is not None and entry.fresh(time.time(), {}):
+                    outcomes['fresh'] += 1
+                    return
+                download = in_flight.get(url) or start_download(url, hostname, path, {}, entry, key, cached)
+                while not download.done:
+                    await download.changed
+            finally:
+                if cached is not None and not isinstance(cached, bytes):
+                    cached.close()
+            if download.error is not None:
+                outcomes['failed'] += 1
+            elif download.entry is not None or download.not_modified:
+                outcomes['stored'] += 1
+            else:
+                outcomes['not stored'] += 1
+
+    await asyncio.gather(*(load(url) for url in urls))
+    upstream_pool.close()
+    await asyncio.sleep(0) # lets the closed connections finish before the loop ends
+    print(f"Preloaded {len(urls)} urls:", ", ".join(f"{count} {outcome}" for outcome, count in outcomes.items()))
+
+# Answers with an error of the proxy's own, returns the status code and the bytes sent
+async def send_error(client_writer, status, reason):
+    response = error_response(HttpParseError(status, reason))
+    client_writer.write(response)
+    await client_writer.drain()
+    return status, len(response)
+
+# Connects to an origin for a relay that bypasses the cache, None when it can't be reached
+async def open_tunnel(client_writer, host, port, timer):
+    try:
+        tunnel = await asyncio.wait_for(
+            upstream_pool.connect(host, port, lambda: Tunnel(client_writer, upstream_buffer)), upstream_timeout)
+    except (OSError, asyncio.TimeoutError) as e:
+        print("Exception:", e)
+        metrics.count('errors_total')
+        return None
+    timer.mark('upstream_connect')
+    metrics.count('tunnels_total')
+    return tunnel
+
+# CONNECT: once the origin is reached the connection carries whatever the two ends send each other, TLS for https.
+# early is what the client sent after the request head without waiting for the 200.
+async def connect_tunnel(client_reader, client_writer, request, early, timer):
+    host, _, port = request.path.rpartition(':')
+    port = port_number(port)
+    if not host or port is None:
+        return await send_error(client_writer, 400, "Bad Request")
+    tunnel = await open_tunnel(client_writer, host, port, timer)
+    if tunnel is None:
+        return await send_error(client_writer, 502, "Bad Gateway")
+    head = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+    client_writer.write(head)
+    await tunnel.relay(client_reader, early)
+    return 200, len(head) + tunnel.relayed
+
+# Methods other than GET go to the origin as they came and its response is relayed byte for byte, past the cache.
+# A successful unsafe request drops the cached copies of its url (RFC 9111 section 4.4).
+async def pass_through(client_writer, request, hostname, path, timer):
+    host, _, port = hostname.partition(':')
+    tunnel = await open_tunnel(client_writer, host, int(port or 80), timer)
+    if tunnel is None:
+        return await send_error(client_writer, 502, "Bad Gateway")
+    headers = forward_headers(request.headers, conditions=True)
+    lines = [f"{request.method} {path} HTTP/1.1", f"Host: {hostname}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()] + ["Connection: close"]
+    try:
+        await tunnel.send(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+        if request.body:
+            await tunnel.send(request.body)
+        await tunnel.finish()
+    finally:
+        tunnel.close()
+    if not tunnel.relayed:
+        return await send_error(client_writer, 502, "Bad Gateway")
+    status = int(tunnel.first[9:12]) if tunnel.first[:5] == b'HTTP/' and tunnel.first[9:12].isdigit() else 502
+    if request.method not in ('HEAD', 'OPTIONS', 'TRACE') and 200 <= status < 400:
+        url = hostname + path
+        memory_cache.remove(url)
+        cache_store.invalidate(url)
+    return status, tunnel.relayed
+
+# Runs the event loop of one process until it is interrupted
+async def serve(port, backlog, reuse_port):
+    warm_memory()
+    server = await asyncio.start_server(handle_client, None, port, backlog=backlog, reuse_address=True,
+                                        reuse_port=reuse_port or None)
+    reaper = asyncio.create_task(upstream_pool.reap())
+    async with server:
+        await server.serve_forever()
+    reaper.cancel()
+
+# Copies the tunables from the command line into the module settings.
+# Worker processes call this again since they may not inherit the parent's globals.
+def apply_args(args):
+    global cache_directory, cache_bytes, cache_policy, cache_store, memory_bytes, memory_max_object, memory_cache
+    global upstream_max_per_host, upstream_idle_timeout, upstream_buffer, dns_ttl, dns_negative_ttl
+    global upstream_pool, hot_urls, access_log
+    cache_directory = args.cache_dir
+    cache_bytes = args.cache_size * 1024 * 1024
+    cache_policy = args.cache_policy
+    cache_store = CacheStore(cache_directory, cache_bytes, cache_policy)
+    memory_bytes = args.memory_cache * 1024 * 1024
+    memory_max_object = args.memory_max_object * 1024
+    memory_cache = MemoryCache(memory_bytes, memory_max_object)
+    upstream_max_per_host = args.upstream_max_per_host
+    upstream_idle_timeout = args.upstream_idle_timeout
+    upstream_buffer = args.upstream_buffer * 1024
+    hot_urls = args.hot_urls
+    dns_ttl = args.dns_ttl
+    dns_negative_ttl = args.dns_negative_ttl
+    upstream_pool = ConnectionPool(upstream_max_per_host, upstream_idle_timeout, upstream_timeout,
+                                   Resolver(dns_ttl, dns_negative_ttl, args.hosts_file), upstream_buffer)
+    access_log = AccessLog(args.access_log, args.log_sample)
+
+# Body of one worker process, it owns its own SO_REUSEPORT socket and metrics slot
+def process_worker(args, shared_metrics, slot):
+    global metrics, shared_store
+    apply_args(args)
+    shared_store = True
+    metrics = shared_metrics
+    metrics.slot = slot
+    try:
+        asyncio.run(serve(args.port, args.backlog, True))
+    except KeyboardInterrupt:
+        pass
+    cache_store.close()
+
+# Command line options
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description="Caching HTTP proxy server")
+    arg_parser.add_argument('--port', type=int, default=server_port)
+    arg_parser.add_argument('--cache-dir', default=cache_directory)
+    arg_parser.add_argument('--cache-size', type=int, default=cache_bytes // (1024 * 1024),
+                            help="MB the disk cache may use before evicting")
+    arg_parser.add_argument('--cache-policy', choices=sorted(POLICIES), default=cache_policy,
+                            help="which entries are evicted first: least recently or least frequently used")
+    arg_parser.add_argument('--memory-cache', type=int, default=memory_bytes // (1024 * 1024),
+                            help="MB of small hot responses kept in memory, 0 disables the memory tier")
+    arg_parser.add_argument('--memory-max-object', type=int, default=memory_max_object // 1024,
+                            help="KB, larger responses are sent from disk")
+    arg_parser.add_argument('--upstream-max-per-host', type=int, default=upstream_max_per_host,
+                            help="connections open to one origin at once")
+    arg_parser.add_argument('--upstream-idle-timeout', type=float, default=upstream_idle_timeout,
+                            help="seconds an unused origin connection is kept open")
+    arg_parser.add_argument('--upstream-buffer', type=int, default=upstream_buffer // 1024,
+                            help="receive buffer of each origin connection in KB")
+    arg_parser.add_argument('--preload', default=None,
+                            help="file of urls, one per line, fetched into the cache before serving")
+    arg_parser.add_argument('--preload-concurrency', type=int, default=16, help="preload fetches run at once")
+    arg_parser.add_argument('--hot-urls', type=int, default=hot_urls,
+                            help="urls of the most used entries written to hot_urls.txt in the cache directory "
+                                 "on shutdown, for --preload, 0 disables")
+    arg_parser.add_argument('--dns-ttl', type=float, default=dns_ttl, help="seconds a resolved origin name is reused")
+    arg_parser.add_argument('--dns-negative-ttl', type=float, default=dns_negative_ttl,
+                            help="seconds a name that failed to resolve is not looked up again")
+    arg_parser.add_argument('--hosts-file', default=None,
+                            help="file in /etc/hosts format whose names take precedence over DNS")
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help="event loop processes sharing the port with SO_REUSEPORT")
+    arg_parser.add_argument('--backlog', type=int, default=server_backlog, help="listen() backlog")
+    arg_parser.add_argument('--access-log', default=None, help="file to write the access log to, - for stdout")
+    arg_parser.add_argument('--log-sample', type=float, default=1.0,
+                            help="fraction of requests written to the access log")
+    return arg_parser.parse_args()
+
+def main():
+    args = parse_args()
+    apply_args(args)
+    signal.signal(signal.SIGTERM, signal.default_int_handler) # stops like Ctrl-C, workers inherit it
+
+    # Cache Creation
+    cache_store.recover()
+    if args.preload:
+        asyncio.run(preload(args.preload, args.preload_concurrency))
+    hot_path = os.path.join(cache_directory, 'hot_urls.txt')
+
+    workers = args.workers
+    if workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        print("SO_REUSEPORT is not available on this platform, running a single event loop")
+        workers = 1
+    print("The proxy is ready to receive! Listening on Port:", args.port, "Workers:", workers)
+    if workers == 1:
+        try:
+            asyncio.run(serve(args.port, args.backlog, False))
+        except KeyboardInterrupt:
+            print("Shutting down")
+        if hot_urls:
+            export_hot(cache_store, hot_path, hot_urls)
+        cache_store.close()
+        return
+    cache_store.close() # the workers open their own
+
+    # Every worker records into its own slot of one shared Metrics, so /__metrics shows all of them
+    shared_metrics = Metrics('proxy', metric_stages, metric_counters, slots=workers)
+    processes = [multiprocessing.Process(target=process_worker, args=(args, shared_metrics, slot), daemon=True)
+                 for slot in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("Shutting down")
+        for process in processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+                process.join(1)
+    if hot_urls: # the workers' accesses are all in the index once they have closed their stores
+        store = CacheStore(cache_directory, cache_bytes, cache_policy)
+        export_hot(store, hot_path, hot_urls)
+        store.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+'''
+Name resolution for proxyserver.py's origin connections.
+Lookups run in the event loop's thread pool (loop.getaddrinfo) so a slow resolver only delays
+the requests waiting on that name, concurrent lookups of one name share a single query, and
+answers, failures included, are cached for a while. A hosts file can pin names to addresses,
+which lets local test origins stand in for real hosts.
+'''
+import asyncio
+import ipaddress
+import socket
+import time
+from collections import OrderedDict
+
+
+class Resolver:
+    '''
+    Caching resolver. getaddrinfo doesn't report record TTLs, so answers are kept for ttl
+    seconds and failures for negative_ttl seconds.
+    '''
+    def __init__(self, ttl=60.0, negative_ttl=5.0, hosts_file=None, max_entries=4096):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hosts = load_hosts(hosts_file) if hosts_file else {}
+        self.entries = OrderedDict() # host -> (expires, [(family, ip)] or the OSError it failed with)
+        self.pending = {} # host -> lookup in progress
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    async def resolve(self, host, port):
+        '''
+        [(family, (ip, port))] to try in order for host:port, raises socket.gaierror when host doesn't resolve
+        '''
+        host = host.lower()
+        addresses = self.hosts.get(host) or literal(host)
+        if addresses is None:
+            entry = self.entries.get(host)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                self.entries.move_to_end(host)
+                addresses = entry[1]
+            else:
+                self.misses += 1
+                lookup = self.pending.get(host)
+                if lookup is None:
+                    lookup = self.pending[host] = asyncio.ensure_future(self.lookup(host))
+                    lookup.add_done_callback(lambda done: done.cancelled() or done.exception())
+                # One waiter giving up doesn't cancel the lookup for the others
+                addresses = await asyncio.shield(lookup)
+            if isinstance(addresses, OSError):
+                raise socket.gaierror(*addresses.args)
+        return [(family, (ip, port)) for family, ip in addresses]
+
+    async def lookup(self, host):
+        '''
+        Queries the system resolver and caches the answer or the failure
+        '''
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+            addresses = list(dict.fromkeys((family, sockaddr[0]) for family, _, _, _, sockaddr in infos))
+            self.store(host, self.ttl, addresses)
+            return addresses
+        except OSError as e:
+            self.failures += 1
+            self.store(host, self.negative_ttl, e)
+            return e
+        finally:
+            del self.pending[host]
+
+    def store(self, host, ttl, answer):
+        self.entries[host] = (time.monotonic() + ttl, answer)
+        self.entries.move_to_end(host)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'failures': self.failures,
+                'entries': len(self.entries), 'pinned': len(self.hosts)}
+
+
+def literal(host):
+    '''
+    [(family, ip)] when host is already an IP address, otherwise None
+    '''
+    try:
+        address = ipaddress.ip_address(host.strip('[]'))
+    except ValueError:
+        return None
+    return [(socket.AF_INET6 if address.version == 6 else socket.AF_INET, str(address))]
+
+
+def load_hosts(path):
+    '''
+    {name: [(family, ip)]} from a file in /etc/hosts format
+    '''
+    hosts = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if len(fields) < 2:
+                continue
+            address = literal(fields[0])
+            if address is None:
+                continue
+            for name in fields[1:]:
+                hosts.setdefault(name.lower(), []).extend(address)
+    return hosts
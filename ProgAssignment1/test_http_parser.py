@@ -0,0 +1,143 @@
+'''
+Unit tests for http_parser.py: heads split across reads, size limits, malformed requests and pipelining.
+Run with python -m unittest (or pytest) from this directory.
+'''
+import unittest
+
+from http_parser import HttpParseError, HttpRequest, RequestParser, error_response, parse_head
+
+
+def requests_from(parser, *chunks):
+    '''
+    Feeds the chunks one after the other and collects every request that becomes complete
+    '''
+    requests = []
+    for chunk in chunks:
+        parser.feed(chunk)
+        request = parser.next_request()
+        while request is not None:
+            requests.append(request)
+            request = parser.next_request()
+    return requests
+
+
+class SplitTest(unittest.TestCase):
+    def test_split_reads(self):
+        raw = b"POST /form HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n\r\nhello"
+        cases = [
+            ('whole', [raw]),
+            ('byte by byte', [raw[i:i + 1] for i in range(len(raw))]),
+            ('inside the blank line', [raw[:raw.index(b"\r\n\r\n") + 2], raw[raw.index(b"\r\n\r\n") + 2:]]),
+            ('inside the body', [raw[:-3], raw[-3:]]),
+        ]
+        for name, chunks in cases:
+            with self.subTest(name):
+                requests = requests_from(RequestParser(), *chunks)
+                self.assertEqual(len(requests), 1)
+                request = requests[0]
+                self.assertEqual((request.method, request.path, request.version), ('POST', '/form', 'HTTP/1.1'))
+                self.assertEqual(request.headers, {'host': 'x', 'content-length': '5'})
+                self.assertEqual(request.body, b"hello")
+
+    def test_line_endings(self):
+        cases = [
+            b"GET / HTTP/1.1\r\nHost: x\r\n\r\n",
+            b"GET / HTTP/1.1\nHost: x\n\n",
+            b"\r\nGET / HTTP/1.1\r\nHost: x\r\n\r\n", # a stray CRLF before the request line
+        ]
+        for raw in cases:
+            with self.subTest(raw=raw):
+                request, = requests_from(RequestParser(), raw)
+                self.assertEqual(request.request_line, "GET / HTTP/1.1")
+                self.assertEqual(request.headers, {'host': 'x'})
+                self.assertEqual(request.body, b"")
+
+    def test_incomplete(self):
+        parser = RequestParser()
+        self.assertEqual(requests_from(parser, b"GET / HTTP/1.1\r\nHost: x\r\n"), [])
+        self.assertEqual(requests_from(parser, b"\r\nPOST / HTTP/1.1\r\nContent-Length: 4\r\n\r\nab")[0].method, 'GET')
+        self.assertIsNone(parser.next_request())
+        self.assertEqual(requests_from(parser, b"cd")[0].body, b"abcd")
+
+
+class ErrorTest(unittest.TestCase):
+    def test_errors(self):
+        cases = [
+            ('head over the limit, unfinished', b"GET / HTTP/1.1\r\nX: " + b"a" * 200, 431),
+            ('head over the limit, finished', b"GET / HTTP/1.1\r\nX: " + b"a" * 200 + b"\r\n\r\n", 431),
+            ('body over the limit', b"POST / HTTP/1.1\r\nContent-Length: 1001\r\n\r\n", 413),
+            ('two words', b"GET /\r\n\r\n", 400),
+            ('not HTTP', b"GET / FTP/1.0\r\n\r\n", 400),
+            ('header without colon', b"GET / HTTP/1.1\r\nHost x\r\n\r\n", 400),
+            ('length not a number', b"POST / HTTP/1.1\r\nContent-Length: -1\r\n\r\n", 400),
+            ('chunked', b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n", 411),
+        ]
+        for name, raw, status in cases:
+            with self.subTest(name):
+                parser = RequestParser(max_header_bytes=128, max_body_bytes=1000)
+                with self.assertRaises(HttpParseError) as caught:
+                    requests_from(parser, raw)
+                self.assertEqual(caught.exception.status, status)
+
+    def test_limits_allow_exact_size(self):
+        parser = RequestParser(max_header_bytes=128, max_body_bytes=4)
+        head = b"POST / HTTP/1.1\r\nContent-Length: 4\r\nX: "
+        head += b"a" * (128 - len(head))
+        request, = requests_from(parser, head + b"\r\n\r\nbody")
+        self.assertEqual(request.body, b"body")
+
+    def test_error_response(self):
+        response = error_response(HttpParseError(431, "Request Header Fields Too Large"))
+        head, _, body = response.partition(b"\r\n\r\n")
+        self.assertTrue(head.startswith(b"HTTP/1.1 431 Request Header Fields Too Large\r\n"))
+        self.assertIn(b"Connection: close", head)
+        self.assertIn(b"Content-Length: %d" % len(body), head)
+
+
+class PipelineTest(unittest.TestCase):
+    def test_pipelined(self):
+        raw = (b"GET /a HTTP/1.1\r\nHost: x\r\n\r\n"
+               b"POST /b HTTP/1.1\r\nContent-Length: 3\r\n\r\nxyz"
+               b"HEAD /c HTTP/1.0\r\n\r\n")
+        cases = [
+            ('one read', [raw]),
+            ('split in the second body', [raw[:raw.index(b"xyz") + 1], raw[raw.index(b"xyz") + 1:]]),
+            ('byte by byte', [raw[i:i + 1] for i in range(len(raw))]),
+        ]
+        for name, chunks in cases:
+            with self.subTest(name):
+                parser = RequestParser()
+                requests = requests_from(parser, *chunks)
+                self.assertEqual([request.request_line for request in requests],
+                                 ["GET /a HTTP/1.1", "POST /b HTTP/1.1", "HEAD /c HTTP/1.0"])
+                self.assertEqual([request.body for request in requests], [b"", b"xyz", b""])
+                self.assertEqual(parser.buffer, b"")
+
+    def test_started(self):
+        parser = RequestParser()
+        first, second = requests_from(parser, b"GET /a HTTP/1.1\r\n\r\nGET /b HTTP/1.1\r\n\r\n")
+        self.assertIsNotNone(first.started)
+        self.assertGreaterEqual(second.started, first.started)
+
+
+class KeepAliveTest(unittest.TestCase):
+    def test_keep_alive(self):
+        cases = [
+            ('HTTP/1.1', {}, True),
+            ('HTTP/1.1', {'connection': 'close'}, False),
+            ('HTTP/1.1', {'connection': 'Keep-Alive'}, True),
+            ('HTTP/1.0', {}, False),
+            ('HTTP/1.0', {'connection': 'keep-alive'}, True),
+            ('HTTP/1.0', {'connection': 'Keep-Alive, Upgrade'}, True),
+        ]
+        for version, headers, expected in cases:
+            with self.subTest(version=version, headers=headers):
+                self.assertIs(HttpRequest('GET', '/', version, headers).keep_alive, expected)
+
+    def test_parse_head_headers(self):
+        request = parse_head("GET /x HTTP/1.1\r\nHost:  example.com \r\nX-Thing: a:b")
+        self.assertEqual(request.headers, {'host': 'example.com', 'x-thing': 'a:b'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+'''
+Unit tests for proxy_cache.py: storability, freshness lifetime, age and Vary.
+Run with python -m unittest (or pytest) from this directory.
+'''
+import unittest
+
+from proxy_cache import Entry, cache_control, freshness_lifetime, parse_head, storable, vary_key, vary_names
+
+DATE = 'Sun, 06 Nov 1994 08:49:37 GMT'
+DATE_EPOCH = 784111777.0
+
+
+def response_head(status, *headers):
+    return '\r\n'.join([f"HTTP/1.1 {status} X"] + list(headers))
+
+
+class ParseTest(unittest.TestCase):
+    def test_parse_head(self):
+        status, headers = parse_head(response_head(200, 'Vary: Accept', 'vary: Cookie', 'Bad line', 'ETag: "x"'))
+        self.assertEqual(status, 200)
+        self.assertEqual(headers, {'vary': 'Accept, Cookie', 'etag': '"x"'})
+        self.assertEqual(parse_head('garbage')[0], 0)
+
+    def test_cache_control(self):
+        cases = [
+            ({'cache-control': 'max-age=60, no-cache'}, {'max-age': '60', 'no-cache': True}),
+            ({'cache-control': 'Private, s-maxage="5"'}, {'private': True, 's-maxage': '5'}),
+            ({'pragma': 'no-cache'}, {'no-cache': True}),
+            ({'pragma': 'no-cache', 'cache-control': 'max-age=1'}, {'max-age': '1'}),
+            ({}, {}),
+        ]
+        for headers, expected in cases:
+            with self.subTest(headers=headers):
+                self.assertEqual(cache_control(headers), expected)
+
+
+class StorableTest(unittest.TestCase):
+    def test_storable(self):
+        cases = [
+            (200, {'cache-control': 'max-age=60'}, {}, True),
+            (301, {'cache-control': 'max-age=60'}, {}, True),
+            (404, {'cache-control': 'max-age=60'}, {}, False),
+            (206, {'cache-control': 'max-age=60'}, {}, False),
+            (200, {'cache-control': 'no-store, max-age=60'}, {}, False),
+            (200, {'cache-control': 'max-age=60'}, {'cache-control': 'no-store'}, False),
+            (200, {'cache-control': 'private, max-age=60'}, {}, False),
+            (200, {'cache-control': 'max-age=60', 'vary': 'Accept, *'}, {}, False),
+            (200, {'cache-control': 'max-age=60'}, {'authorization': 'Basic x'}, False),
+            (200, {'cache-control': 'public, max-age=60'}, {'authorization': 'Basic x'}, True),
+            (200, {'cache-control': 's-maxage=60'}, {'authorization': 'Basic x'}, True),
+            (200, {'etag': '"v1"'}, {}, True), # never fresh but can be revalidated
+            (200, {'last-modified': DATE}, {}, True),
+            (200, {}, {}, False),
+            (200, {'cache-control': 'max-age=0'}, {}, False),
+        ]
+        for status, headers, request_headers, expected in cases:
+            with self.subTest(status=status, headers=headers, request_headers=request_headers):
+                self.assertIs(storable(status, headers, request_headers), expected)
+
+
+class FreshnessTest(unittest.TestCase):
+    def test_freshness_lifetime(self):
+        cases = [
+            ({'cache-control': 's-maxage=10, max-age=60'}, 10),
+            ({'cache-control': 'max-age=60', 'expires': 'Sun, 06 Nov 1994 09:49:37 GMT'}, 60),
+            ({'cache-control': 'max-age=abc'}, 0),
+            ({'date': DATE, 'expires': 'Sun, 06 Nov 1994 09:49:37 GMT'}, 3600),
+            ({'date': DATE, 'expires': 'Sun, 06 Nov 1994 07:49:37 GMT'}, 0),
+            ({'date': DATE, 'expires': '0'}, 0), # invalid Expires means already expired
+            ({'date': DATE, 'last-modified': 'Sun, 06 Nov 1994 07:49:37 GMT'}, 360), # 10% of an hour
+            ({'date': DATE, 'last-modified': 'Sun, 06 Nov 1984 08:49:37 GMT'}, 24 * 60 * 60), # capped
+            ({'date': DATE, 'last-modified': 'Sun, 06 Nov 1994 09:49:37 GMT'}, 0), # in the future
+            ({'date': DATE}, 0),
+        ]
+        for headers, expected in cases:
+            with self.subTest(headers=headers):
+                self.assertAlmostEqual(freshness_lifetime(headers, DATE_EPOCH), expected)
+
+    def test_freshness_lifetime_without_date(self):
+        # Expires is measured from the response time when the Date header is missing
+        headers = {'expires': 'Sun, 06 Nov 1994 08:50:37 GMT'}
+        self.assertAlmostEqual(freshness_lifetime(headers, DATE_EPOCH), 60)
+
+
+class EntryTest(unittest.TestCase):
+    def entry(self, *headers, request_headers=None, request_time=DATE_EPOCH - 2, response_time=DATE_EPOCH):
+        head = response_head(200, f"Date: {DATE}", *headers)
+        return Entry(200, head, len(head) + 4, request_headers or {}, request_time, response_time)
+
+    def test_age(self):
+        # corrected age: Age header plus the 2 s the request took, then the time since the response
+        cases = [
+            ((), DATE_EPOCH, 2),
+            ((), DATE_EPOCH + 10, 12),
+            (('Age: 30',), DATE_EPOCH, 32),
+            (('Age: 30',), DATE_EPOCH + 5, 37),
+            (('Age: junk',), DATE_EPOCH, 2),
+        ]
+        for headers, now, expected in cases:
+            with self.subTest(headers=headers, now=now):
+                self.assertAlmostEqual(self.entry(*headers).age(now), expected)
+
+    def test_apparent_age(self):
+        # a response dated before it arrived is at least that old
+        entry = self.entry(request_time=DATE_EPOCH + 99, response_time=DATE_EPOCH + 100)
+        self.assertAlmostEqual(entry.age(DATE_EPOCH + 100), 100)
+
+    def test_fresh(self):
+        cases = [
+            (('Cache-Control: max-age=60',), DATE_EPOCH, {}, True),
+            (('Cache-Control: max-age=60',), DATE_EPOCH + 57, {}, True),
+            (('Cache-Control: max-age=60',), DATE_EPOCH + 58, {}, False),
+            (('Cache-Control: max-age=60', 'Age: 59'), DATE_EPOCH, {}, False),
+            (('Cache-Control: max-age=60, no-cache',), DATE_EPOCH, {}, False),
+            (('Cache-Control: max-age=60',), DATE_EPOCH, {'cache-control': 'no-cache'}, False),
+            (('Cache-Control: max-age=60',), DATE_EPOCH + 10, {'cache-control': 'max-age=5'}, False),
+            (('Cache-Control: max-age=60',), DATE_EPOCH + 10, {'cache-control': 'max-age=20'}, True),
+            (('Pragma: no-cache',), DATE_EPOCH, {}, False),
+        ]
+        for headers, now, request_headers, expected in cases:
+            with self.subTest(headers=headers, now=now, request_headers=request_headers):
+                self.assertIs(self.entry(*headers).fresh(now, request_headers), expected)
+
+    def test_round_trip(self):
+        entry = self.entry('Cache-Control: max-age=60', 'Vary: Accept-Language',
+                           request_headers={'accept-language': 'en'})
+        copy = Entry.from_dict(entry.to_dict())
+        self.assertEqual(copy.to_dict(), entry.to_dict())
+        self.assertTrue(copy.fresh(DATE_EPOCH, {}))
+
+    def test_response_head_age(self):
+        head = self.entry('Age: 30').response_head(DATE_EPOCH + 10).decode('latin-1')
+        self.assertIn('\r\nAge: 42\r\n\r\n', head)
+        self.assertEqual(head.count('Age:'), 1)
+
+
+class VaryTest(unittest.TestCase):
+    def test_vary_names(self):
+        cases = [
+            ({}, []),
+            ({'vary': 'Accept-Encoding'}, ['accept-encoding']),
+            ({'vary': 'Cookie, accept-encoding,, Cookie'}, ['accept-encoding', 'cookie']),
+        ]
+        for headers, expected in cases:
+            with self.subTest(headers=headers):
+                self.assertEqual(vary_names(headers), expected)
+
+    def test_vary_key(self):
+        names = ['accept-encoding', 'accept-language']
+        gzip_en = vary_key(names, {'accept-encoding': 'gzip', 'accept-language': 'en', 'cookie': 'a'})
+        self.assertEqual(vary_key([], {'accept-encoding': 'gzip'}), '')
+        self.assertEqual(gzip_en, vary_key(names, {'accept-encoding': 'gzip', 'accept-language': 'en'}))
+        self.assertNotEqual(gzip_en, vary_key(names, {'accept-encoding': 'gzip', 'accept-language': 'de'}))
+        self.assertNotEqual(gzip_en, vary_key(names, {'accept-encoding': 'gzip'}))
+
+    def test_matches(self):
+        head = response_head(200, 'Vary: Accept-Encoding')
+        entry = Entry(200, head, len(head) + 4, {'accept-encoding': 'gzip'}, DATE_EPOCH, DATE_EPOCH)
+        cases = [
+            ({'accept-encoding': 'gzip'}, True),
+            ({'accept-encoding': 'gzip', 'cookie': 'a'}, True),
+            ({'accept-encoding': 'br'}, False),
+            ({}, False),
+        ]
+        for request_headers, expected in cases:
+            with self.subTest(request_headers=request_headers):
+                self.assertIs(entry.matches(request_headers), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+'''
+Raw byte relay between a proxyserver.py client and an origin, for CONNECT tunnels and for
+requests the cache has nothing to do with. The origin side receives with recv_into into one
+buffer that is reused for every read and hands each read straight to the client's transport,
+so bytes are not copied again unless the client can't take them right away. Each direction
+stops reading while the other side's send buffer is full, so neither end is buffered without limit.
+'''
+import asyncio
+
+
+class Tunnel(asyncio.BufferedProtocol):
+    '''
+    Origin side of a relay to one client. ended is set once the origin has sent everything,
+    relayed counts the bytes passed on to the client and first keeps the start of them.
+    '''
+    def __init__(self, client_writer, buffer_size):
+        self.client_writer = client_writer
+        self.buffer = memoryview(bytearray(buffer_size))
+        self.transport = None
+        self.relayed = 0
+        self.first = b""
+        self.ended = asyncio.get_running_loop().create_future()
+        self.lost = False # the origin closed both directions
+        self.writable = None # future while the origin's send buffer is full
+        self.draining = None # task waiting for the client to take what was sent to it
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.buffer
+
+    def buffer_updated(self, nbytes):
+        client = self.client_writer.transport
+        if client.is_closing():
+            self.transport.close()
+            return
+        client.write(self.buffer[:nbytes])
+        if not self.relayed:
+            self.first = bytes(self.buffer[:min(nbytes, 16)])
+        self.relayed += nbytes
+        if client.get_write_buffer_size():
+            # The transport may keep a reference to the part it couldn't send, the next read gets a new buffer
+            self.buffer = memoryview(bytearray(len(self.buffer)))
+            if client.get_write_buffer_size() > len(self.buffer) and self.draining is None:
+                self.transport.pause_reading()
+                self.draining = asyncio.ensure_future(self.drain_client())
+
+    async def drain_client(self):
+        '''
+        Reading resumes once the client has taken what it was sent, the tunnel ends if it went away
+        '''
+        try:
+            await self.client_writer.drain()
+        except ConnectionError:
+            self.transport.close()
+            return
+        finally:
+            self.draining = None
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        # Passes the half close on and keeps the other direction open
+        if self.client_writer.can_write_eof() and not self.client_writer.transport.is_closing():
+            self.client_writer.write_eof()
+        self.end()
+        return True
+
+    def connection_lost(self, exc):
+        self.lost = True
+        self.end()
+        self.resume_writing()
+
+    def end(self):
+        if not self.ended.done():
+            self.ended.set_result(None)
+
+    def pause_writing(self):
+        if self.writable is None:
+            self.writable = asyncio.get_running_loop().create_future()
+
+    def resume_writing(self):
+        if self.writable is not None:
+            self.writable.set_result(None)
+            self.writable = None
+
+    async def send(self, data):
+        '''
+        Writes to the origin, waiting while its send buffer is full
+        '''
+        if self.transport.is_closing():
+            raise ConnectionResetError("origin closed the connection")
+        self.transport.write(data)
+        if self.writable is not None:
+            await self.writable
+
+    async def pump(self, client_reader, early):
+        '''
+        Relays the client's bytes to the origin until the client is done sending.
+        early is what the client sent after its request head before the tunnel was open.
+        '''
+        if early:
+            await self.send(early)
+        while True:
+            data = await client_reader.read(len(self.buffer))
+            if not data:
+                break
+            await self.send(data)
+        if self.transport.can_write_eof() and not self.transport.is_closing():
+            self.transport.write_eof()
+
+    async def relay(self, client_reader, early):
+        '''
+        Runs both directions until each has ended, or until the origin has closed the connection,
+        then closes it
+        '''
+        pump = asyncio.ensure_future(self.pump(client_reader, early))
+        try:
+            await asyncio.wait([pump, self.ended], return_when=asyncio.FIRST_COMPLETED)
+            if pump.done():
+                await pump
+                await self.ended
+            elif not self.lost: # the origin only half closed, the client may still be sending
+                await pump
+        finally:
+            pump.cancel()
+            self.close()
+
+    async def finish(self):
+        '''
+        Waits for the origin to send everything and closes the connection, for requests relayed one way
+        '''
+        try:
+            await self.ended
+        finally:
+            self.close()
+
+    def close(self):
+        self.transport.close()
+        if self.draining is not None:
+            self.draining.cancel()
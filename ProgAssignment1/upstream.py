@@ -0,0 +1,375 @@
+'''
+Persistent HTTP/1.1 connections from proxyserver.py to origin servers.
+A ConnectionPool keeps idle connections per (host, port) for reuse, limits how many are open
+to one origin, checks an idle connection is still usable before handing it out and closes the
+ones that sat idle too long. Origin names go through a caching Resolver.
+Each connection receives with recv_into into one buffer of its own that is reused for every read,
+and bodies are handed out as views of that buffer, so relaying a response allocates nothing per read.
+Response bodies are read by their framing (Content-Length, chunked or until close), which is what
+makes it safe to send the next request on the same connection.
+'''
+import asyncio
+import time
+from collections import deque
+from resolver import Resolver
+
+# body_length() results besides a byte count
+CHUNKED = -1
+UNTIL_CLOSE = -2
+
+
+class Connection(asyncio.BufferedProtocol):
+    '''
+    One connection to an origin, reused says whether it already carried a response.
+    The bytes received and not yet consumed are buffer[start:end]. Reading pauses while the buffer is full.
+    '''
+    def __init__(self, key, buffer_size):
+        self.key = key
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = self.end = 0
+        self.transport = None
+        self.paused = False
+        self.eof = False
+        self.error = None # what ended the connection, None for a clean close
+        self.waiter = None
+        self.reused = False
+        self.idle_since = time.monotonic()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer): # move what is unread to the front to make room
+            unread = self.end - self.start
+            self.view[:unread] = self.view[self.start:self.end] # memoryview copies with memmove
+            self.start, self.end = 0, unread
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        if self.end == len(self.buffer):
+            self.transport.pause_reading()
+            self.paused = True
+        self.wake()
+
+    def eof_received(self):
+        self.eof = True
+        self.wake()
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.error = exc
+        self.wake()
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def healthy(self, now, idle_timeout):
+        '''
+        Whether an idle connection can carry another request: not expired, and the origin hasn't
+        closed it or sent anything unasked
+        '''
+        return (now - self.idle_since < idle_timeout and not self.transport.is_closing()
+                and not self.eof and self.start == self.end)
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def close(self):
+        self.transport.close()
+
+    async def fill(self, timeout):
+        '''
+        Waits for more bytes, returns False when the connection has ended instead
+        '''
+        if self.eof:
+            return False
+        self.waiter = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(self.waiter, timeout)
+        finally:
+            self.waiter = None
+        return True
+
+    def consume(self, nbytes):
+        self.start += nbytes
+        if self.paused:
+            self.paused = False
+            self.transport.resume_reading()
+
+    async def readuntil(self, separator, timeout):
+        '''
+        Bytes up to and including separator, which has to turn up before the buffer is full
+        '''
+        scanned = 0
+        while True:
+            index = self.buffer.find(separator, self.start + max(0, scanned - len(separator) + 1), self.end)
+            if index >= 0:
+                data = bytes(self.view[self.start:index + len(separator)])
+                self.consume(len(data))
+                return data
+            if self.end - self.start == len(self.buffer):
+                raise ValueError("response head too large")
+            scanned = self.end - self.start
+            if not await self.fill(timeout):
+                partial = bytes(self.view[self.start:self.end])
+                self.consume(len(partial))
+                raise asyncio.IncompleteReadError(partial, None)
+
+    async def peek(self, max_bytes, timeout):
+        '''
+        Up to max_bytes of the unread bytes, waiting for some when there are none, empty once the
+        connection has ended. The view is only valid until consume() is called.
+        '''
+        while self.start == self.end:
+            if not await self.fill(timeout):
+                return self.view[0:0]
+        return self.view[self.start:min(self.end, self.start + max_bytes)]
+
+
+class ConnectionPool:
+    '''
+    Idle connections per origin, LIFO so the warmest one is reused first
+    '''
+    def __init__(self, max_per_host=8, idle_timeout=15.0, connect_timeout=10.0, resolver=None,
+                 buffer_size=256 * 1024):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.resolver = resolver or Resolver()
+        self.buffer_size = buffer_size
+        self.idle = {} # (host, port) -> [Connection]
+        self.open = {} # (host, port) -> connections open, idle or in use
+        self.waiters = {} # (host, port) -> deque of futures waiting for a free slot
+        self.connects = 0
+        self.reuses = 0
+        self.retries = 0
+
+    async def acquire(self, host, port):
+        '''
+        A healthy idle connection to host:port, or a new one when there is none and the origin is
+        below max_per_host, otherwise waits for one to be released
+        '''
+        key = (host, port)
+        while True:
+            idle = self.idle.get(key)
+            now = time.monotonic()
+            while idle:
+                connection = idle.pop()
+                if connection.healthy(now, self.idle_timeout):
+                    connection.reused = True
+                    self.reuses += 1
+                    return connection
+                self.discard(connection)
+
+            if self.open.get(key, 0) < self.max_per_host:
+                self.open[key] = self.open.get(key, 0) + 1
+                try:
+                    connection = await asyncio.wait_for(self.connect(host, port), self.connect_timeout)
+                except BaseException:
+                    self.closed(key)
+                    raise
+                self.connects += 1
+                return connection
+
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.setdefault(key, deque()).append(waiter)
+            try:
+                await waiter
+            except BaseException:
+                if waiter.done() and not waiter.cancelled():
+                    self.wake(key) # pass the released slot on to the next waiter
+                else:
+                    self.waiters[key].remove(waiter)
+                raise
+
+    async def connect(self, host, port, protocol_factory=None):
+        '''
+        Opens a connection to the first address of host that accepts one, returns its protocol.
+        That is a Connection unless protocol_factory makes something else, like a tunnel
+        that is never pooled.
+        '''
+        if protocol_factory is None:
+            protocol_factory = lambda: Connection((host, port), self.buffer_size)
+        addresses = await self.resolver.resolve(host, port)
+        loop = asyncio.get_running_loop()
+        for i, (family, (ip, ip_port)) in enumerate(addresses):
+            try:
+                _, protocol = await loop.create_connection(protocol_factory, ip, ip_port, family=family)
+                return protocol
+            except OSError:
+                if i == len(addresses) - 1:
+                    raise
+
+    def release(self, connection, reusable):
+        '''
+        Returns a connection once its response has been read completely
+        '''
+        if reusable and not connection.transport.is_closing():
+            connection.idle_since = time.monotonic()
+            self.idle.setdefault(connection.key, []).append(connection)
+            self.wake(connection.key)
+        else:
+            self.discard(connection)
+
+    def discard(self, connection):
+        connection.close()
+        self.closed(connection.key)
+
+    def closed(self, key):
+        self.open[key] -= 1
+        if not self.open[key]:
+            del self.open[key]
+        self.wake(key)
+
+    def wake(self, key):
+        waiters = self.waiters.get(key)
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+        if not waiters:
+            self.waiters.pop(key, None)
+
+    async def request(self, host, port, data, timeout, on_connect=None):
+        '''
+        Sends a request and reads the head of its response, returns (connection, head).
+        on_connect is called once a connection has been acquired.
+        A reused connection the origin closed in the meantime fails before any response
+        arrives, the request is then sent once more on a new connection.
+        '''
+        while True:
+            connection = await asyncio.wait_for(self.acquire(host, port), timeout)
+            if on_connect is not None:
+                on_connect()
+            try:
+                connection.write(data)
+                head = await connection.readuntil(b"\r\n\r\n", timeout)
+                # Interim 1xx responses come before the real one
+                while head[9:10] == b'1' and head[9:12] != b'101':
+                    head = await connection.readuntil(b"\r\n\r\n", timeout)
+                return connection, head
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                self.discard(connection)
+                if not connection.reused or (isinstance(e, asyncio.IncompleteReadError) and e.partial):
+                    raise
+                self.retries += 1
+            except BaseException:
+                self.discard(connection)
+                raise
+
+    def prune(self):
+        '''
+        Closes idle connections that are expired or were closed by their origin
+        '''
+        now = time.monotonic()
+        for key, idle in list(self.idle.items()):
+            keep = [connection for connection in idle if connection.healthy(now, self.idle_timeout)]
+            for connection in idle:
+                if connection not in keep:
+                    self.discard(connection)
+            if keep:
+                self.idle[key] = keep
+            else:
+                del self.idle[key]
+
+    async def reap(self):
+        '''
+        Prunes the pool for as long as the event loop runs
+        '''
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            self.prune()
+
+    def close(self):
+        '''
+        Closes every idle connection, before the event loop they belong to ends
+        '''
+        for idle in self.idle.values():
+            for connection in idle:
+                self.discard(connection)
+        self.idle.clear()
+
+    def stats(self):
+        return {'connects': self.connects, 'reuses': self.reuses, 'retries': self.retries,
+                'open': sum(self.open.values()), 'idle': sum(len(idle) for idle in self.idle.values())}
+
+
+def body_length(status, headers):
+    '''
+    Bytes in the body of a response to a GET, CHUNKED, or UNTIL_CLOSE when only the end of the
+    connection marks its end
+    '''
+    if 100 <= status < 200 or status in (204, 304):
+        return 0
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        return CHUNKED
+    length = headers.get('content-length', '')
+    if length.isdigit():
+        return int(length)
+    return UNTIL_CLOSE
+
+
+def keeps_alive(head, headers, length):
+    '''
+    Whether the connection can carry another request once this response has been read
+    '''
+    if length == UNTIL_CLOSE:
+        return False
+    connection = headers.get('connection', '').lower()
+    if head.startswith(b'HTTP/1.0'):
+        return 'keep-alive' in connection
+    return 'close' not in connection
+
+
+async def read_body(connection, length, timeout):
+    '''
+    Yields the body as views of the connection's buffer, each one only valid until the next is
+    asked for. Chunked bodies are decoded. Raises IncompleteReadError when the connection ends
+    before the body does, or the error that broke off a body delimited by the end of the connection.
+    '''
+    if length == UNTIL_CLOSE:
+        while True:
+            view = await connection.peek(len(connection.buffer), timeout)
+            if not view:
+                if connection.error is not None:
+                    raise connection.error
+                return
+            nbytes = len(view)
+            yield view
+            connection.consume(nbytes)
+
+    elif length == CHUNKED:
+        while True:
+            line = await connection.readuntil(b"\r\n", timeout)
+            size = int(line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # Trailers are not passed on
+                while await connection.readuntil(b"\r\n", timeout) != b"\r\n":
+                    pass
+                return
+            async for view in read_exactly(connection, size, timeout):
+                yield view
+            if await connection.readuntil(b"\r\n", timeout) != b"\r\n":
+                raise ValueError("malformed chunked body")
+
+    else:
+        async for view in read_exactly(connection, length, timeout):
+            yield view
+
+
+async def read_exactly(connection, length, timeout):
+    remaining = length
+    while remaining:
+        view = await connection.peek(remaining, timeout)
+        if not view:
+            raise asyncio.IncompleteReadError(b"", remaining)
+        nbytes = len(view)
+        yield view
+        connection.consume(nbytes)
+        remaining -= nbytes
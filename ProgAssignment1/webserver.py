@@ -1,44 +1,936 @@
-from socket import *
-
-#connection stuff
-serverPort = 6789
-serverIP = ''
-serverSocket = socket(AF_INET, SOCK_STREAM)
-serverSocket.bind((serverIP, serverPort))
-serverSocket.listen(1)
-
-print("The server is ready to receive! Listening on Port:", serverPort)
-
-while True:
-        # Wait for a connection
-        print("Waiting for input")
-        connectionSocket, addr = serverSocket.accept()
-
-        try:
-            # Receive the message
-            request = connectionSocket.recv(1024).decode()
-            print("Request:", request)
-
-            # Parse the request
-            fileName = request.split('\n')[0].split()[1]
-            if fileName.startswith('/'):
-                fileName = fileName[1:]
-            print("fileName:", fileName)
-
-            # Handle File
-            try: #handle file, returns header + content
-                file = open(fileName, 'rb')
-                content = file.read()
-                file.close()
-                header = b"HTTP/1.1 200 OK\r\n\r\n"
-                http_res = header + content
-            except FileNotFoundError: #handle no file, returns HTML
-                header = b"HTTP/1.1 404 Not Found\r\n\r\n"
-                content = b"<html><body><h1>404 Not Found</h1></body></html>"
-                http_res = header + content
-            connectionSocket.send(http_res)
-        finally:
-            print("Closed Connection")
-            connectionSocket.close()
-
-
+from socket import *
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import errno
+import functools
+import gzip
+import mimetypes
+import multiprocessing
+import os
+import posixpath
+import select
+import selectors
+import threading
+import time
+from collections import OrderedDict, deque
+from email.utils import formatdate, parsedate_to_datetime
+from stat import S_ISDIR, S_ISREG
+from urllib.parse import quote, unquote
+from http_parser import HttpParseError, RequestParser, error_response, read_request, read_request_async
+from metrics import METRICS_PATH, AccessLog, Metrics, RequestTimer, is_local
+
+try:
+    import brotli
+except ImportError: # brotli is optional, without it only gzip is offered
+    brotli = None
+
+#connection stuff
+serverPort = 6789
+serverIP = ''
+serverBacklog = 128
+threadWorkers = 32
+processWorkers = os.cpu_count() or 1
+sendBufferSize = 256 * 1024
+sendBuffers = threading.local()
+keepAliveTimeout = 5 # seconds an idle persistent connection is kept
+maxKeepAliveRequests = 100
+maxIdleConnections = 1024 # persistent connections waiting for a request, the oldest beyond this are closed
+cacheBytes = 64 * 1024 * 1024 # total size of the hot file cache, 0 turns it off
+cacheMaxFileBytes = 1024 * 1024 # larger files are always streamed from disk
+cacheCheckInterval = 1.0 # seconds between mtime/size checks of a cached file
+documentRoot = '.'
+statCacheTtl = 1.0 # seconds a path lookup (found or missing) is remembered
+statCacheEntries = 10000
+indexFile = 'index.html'
+connectionLines = {True: b"Connection: keep-alive\r\n\r\n", False: b"Connection: close\r\n\r\n"}
+maxRanges = 32 # Range headers asking for more pieces than this get the whole file
+rangeBoundary = b"%032x" % int.from_bytes(os.urandom(16), 'big')
+compressBytes = 16 * 1024 * 1024 # memory for compressed variants, 0 turns on-the-fly compression off
+compressMinBytes = 256 # smaller files aren't worth compressing
+compressMaxBytes = 8 * 1024 * 1024 # larger files are only sent compressed from a precompressed sibling
+compressibleTypes = {b'application/javascript', b'application/json', b'application/xml', b'image/svg+xml',
+                     b'application/wasm'}
+
+
+def gzip_compress(data):
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+
+# Content codings we can produce in order of preference, with the suffix of a precompressed sibling file
+serverEncodings = {'gzip': ('.gz', gzip_compress)}
+if brotli is not None:
+    serverEncodings = {'br': ('.br', functools.partial(brotli.compress, quality=9)), **serverEncodings}
+
+
+# MIME type from the file extension, worked out once per path
+@functools.lru_cache(maxsize=4096)
+def content_type(path):
+    guess, _ = mimetypes.guess_type(path)
+    return (guess or 'application/octet-stream').encode()
+
+
+def is_compressible(contentType):
+    return (contentType.startswith(b'text/') or contentType in compressibleTypes
+            or contentType.endswith((b'+json', b'+xml')))
+
+
+# ETag and Last-Modified of a file version, only worked out once per (mtime, size, encoding)
+@functools.lru_cache(maxsize=4096)
+def file_validators(mtime, size, encoding=None):
+    if encoding:
+        etag = b'"%x-%x-%s"' % (mtime, size, encoding.encode())
+    else:
+        etag = b'"%x-%x"' % (mtime, size)
+    lastModified = formatdate(mtime / 1e9, usegmt=True).encode()
+    return etag, lastModified
+
+
+# One file ready to be served: the pre-built 200 header (minus the Connection line),
+# its validators, and a body that is either the bytes (when cached) or the open file.
+# encoding is set for gzip/br variants of a file.
+class FileEntry:
+    __slots__ = ('header', 'body', 'mtime', 'size', 'contentType', 'etag', 'lastModified', 'validators',
+                 'representation', 'checked')
+
+    def __init__(self, body, mtime, size, contentType, encoding=None):
+        self.body = body
+        self.mtime = mtime
+        self.size = size
+        self.contentType = contentType
+        self.etag, self.lastModified = file_validators(mtime, size, encoding)
+
+        # validators go on 200, 206 and 304 responses, representation on responses with a body
+        self.validators = b"ETag: %s\r\nLast-Modified: %s\r\n" % (self.etag, self.lastModified)
+        if is_compressible(contentType):
+            self.validators += b"Vary: Accept-Encoding\r\n"
+        self.representation = b"Content-Type: %s\r\nAccept-Ranges: bytes\r\n" % contentType
+        if encoding:
+            self.representation += b"Content-Encoding: %s\r\n" % encoding.encode()
+        self.header = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n%s%s" % (size, self.representation, self.validators)
+        self.checked = time.monotonic()
+
+    # A response part for count bytes starting at offset
+    def slice(self, offset, count):
+        if isinstance(self.body, bytes):
+            return memoryview(self.body)[offset:offset + count]
+        return (self.body, offset, count)
+
+
+# Byte-budgeted LRU of hot files keyed by path.
+# Entries are trusted for checkInterval seconds, after that a stat decides whether they are still valid.
+class FileCache:
+    def __init__(self, maxBytes, maxFileBytes, checkInterval):
+        self.maxBytes = maxBytes
+        self.maxFileBytes = maxFileBytes
+        self.checkInterval = checkInterval
+        self.entries = OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    # Returns the FileEntry for path, or None when it is missing or the file changed on disk
+    def get(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                self.misses += 1
+                return None
+            fresh = time.monotonic() - entry.checked < self.checkInterval
+            if fresh:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry
+
+        # Revalidate outside the lock so one slow stat doesn't stall every other thread
+        try:
+            stat = os.stat(path)
+            valid = stat.st_mtime_ns == entry.mtime and stat.st_size == entry.size
+        except OSError:
+            valid = False
+        with self.lock:
+            if valid:
+                entry.checked = time.monotonic()
+                if path in self.entries:
+                    self.entries.move_to_end(path)
+                self.hits += 1
+                return entry
+            if self.entries.get(path) is entry:
+                del self.entries[path]
+                self.used -= len(entry.header) + len(entry.body)
+            self.misses += 1
+            return None
+
+    # Whether a file of this size is worth keeping in memory
+    def accepts(self, size):
+        return size <= self.maxFileBytes and size <= self.maxBytes
+
+    # Adds a file, evicting least recently used entries until it fits in the budget
+    def put(self, path, entry):
+        cost = len(entry.header) + len(entry.body)
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.used -= len(old.header) + len(old.body)
+            while self.entries and self.used + cost > self.maxBytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.used -= len(evicted.header) + len(evicted.body)
+                self.evictions += 1
+            self.entries[path] = entry
+            self.used += cost
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.used}
+
+
+# Keys remembered for ttl seconds, a bounded LRU of lookups that came up empty
+class NegativeCache:
+    def __init__(self, ttl, maxEntries):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            expires = self.entries.get(key)
+            return expires is not None and expires > time.monotonic()
+
+    def add(self, key):
+        with self.lock:
+            self.entries[key] = time.monotonic() + self.ttl
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+
+fileCache = FileCache(cacheBytes, cacheMaxFileBytes, cacheCheckInterval)
+# Compressed variants are keyed by (path, mtime, size, encoding), so they never need revalidating
+compressedCache = FileCache(compressBytes, compressBytes, float('inf'))
+# Variants not worth having (no sibling and too small, too big or incompressible), by the same keys.
+# They are forgotten after statCacheTtl so a precompressed sibling added later is still found.
+skippedVariants = NegativeCache(statCacheTtl, statCacheEntries)
+compressing = set() # variants being compressed off the asyncio event loop
+
+# Maps URL paths to files under the document root. Paths are percent-decoded, normalised and
+# resolved through symlinks, anything that ends up outside the root is treated as missing.
+# Results, misses included, are remembered for a short TTL so hot and missing paths skip the filesystem.
+class PathResolver:
+    def __init__(self, root, ttl, maxEntries):
+        self.root = os.path.realpath(root)
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Returns ('file', path), ('redirect', location) for a directory missing its slash, or ('missing', None)
+    def resolve(self, urlPath):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.entries.get(urlPath)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+        result = self.lookup(urlPath)
+        with self.lock:
+            self.entries[urlPath] = (now + self.ttl, result)
+            self.entries.move_to_end(urlPath)
+            if len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+        return result
+
+    # True when a resolved path is inside the document root
+    def contains(self, path):
+        try:
+            return os.path.commonpath([self.root, path]) == self.root
+        except ValueError: # different drives on Windows
+            return False
+
+    def lookup(self, urlPath):
+        path = unquote(urlPath)
+        if '\0' in path or '\\' in path:
+            return ('missing', None)
+        relative = posixpath.normpath('/' + path).lstrip('/') # .. can't climb above the root
+        fullPath = os.path.realpath(os.path.join(self.root, relative))
+        if not self.contains(fullPath):
+            return ('missing', None)
+        try:
+            info = os.stat(fullPath)
+            if S_ISDIR(info.st_mode):
+                if not path.endswith('/'):
+                    return ('redirect', quote(path + '/'))
+                fullPath = os.path.realpath(os.path.join(fullPath, indexFile))
+                if not self.contains(fullPath):
+                    return ('missing', None)
+                info = os.stat(fullPath)
+        except (OSError, ValueError):
+            return ('missing', None)
+        if not S_ISREG(info.st_mode):
+            return ('missing', None)
+        return ('file', fullPath)
+
+
+resolver = PathResolver(documentRoot, statCacheTtl, statCacheEntries)
+
+# Request timings served on /__metrics, and the sampled access log that replaced printing every request
+metricStages = ('accept_wait', 'parse', 'lookup', 'send', 'total')
+metricCounters = ('connections_total', 'requests_total', 'responses_2xx_total', 'responses_3xx_total',
+                  'responses_4xx_total', 'responses_5xx_total', 'bytes_sent_total')
+metrics = Metrics('webserver', metricStages, metricCounters)
+accessLog = AccessLog()
+
+
+# True when the client's copy (If-None-Match / If-Modified-Since) is still current
+def not_modified(request, entry):
+    ifNoneMatch = request.headers.get('if-none-match')
+    if ifNoneMatch is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in ifNoneMatch.split(',')]
+        return '*' in tags or entry.etag.decode() in tags
+    ifModifiedSince = request.headers.get('if-modified-since')
+    if ifModifiedSince is not None:
+        try:
+            since = parsedate_to_datetime(ifModifiedSince).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return entry.mtime // 1_000_000_000 <= since
+    return False
+
+
+# Turns a Range header into a list of (start, end) byte positions, both inclusive.
+# Returns None when the header should be ignored and [] when nothing in it is satisfiable.
+def parse_ranges(value, size):
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for item in spec.split(','):
+        first, dash, last = item.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if not first: # suffix range, the last N bytes
+                count = int(last)
+                if count > 0 and size > 0:
+                    ranges.append((max(0, size - count), size - 1))
+                continue
+            start = int(first)
+            end = int(last) if last else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and end < start):
+            return None
+        if end is None:
+            end = size - 1
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    if len(ranges) > maxRanges:
+        return None
+    return ranges
+
+
+# Picks the ranges to serve, None means the full file. If-Range drops the Range header
+# once the client's copy is out of date.
+def requested_ranges(request, entry):
+    value = request.headers.get('range')
+    if value is None or request.method != 'GET':
+        return None
+    ifRange = request.headers.get('if-range')
+    if ifRange is not None and ifRange not in (entry.etag.decode(), entry.lastModified.decode()):
+        return None
+    return parse_ranges(value, entry.size)
+
+
+# Response parts for a found file: 304, 206 (single or multipart), 416 or the full 200
+def file_response(request, entry, connection):
+    if not_modified(request, entry):
+        return [b"HTTP/1.1 304 Not Modified\r\n" + entry.validators, connection]
+
+    ranges = requested_ranges(request, entry)
+    if ranges is None:
+        return [entry.header, connection, entry.slice(0, entry.size)]
+    if not ranges:
+        header = b"HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */%d\r\nContent-Length: 0\r\n" % (
+            entry.size)
+        return [header, connection]
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        header = b"HTTP/1.1 206 Partial Content\r\nContent-Range: bytes %d-%d/%d\r\nContent-Length: %d\r\n%s" % (
+            start, end, entry.size, end - start + 1, entry.representation + entry.validators)
+        return [header, connection, entry.slice(start, end - start + 1)]
+
+    # Several ranges go out as one multipart/byteranges body, streamed piece by piece
+    body = []
+    for start, end in ranges:
+        body.append(b"--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" % (
+            rangeBoundary, entry.contentType, start, end, entry.size))
+        body.append(entry.slice(start, end - start + 1))
+        body.append(b"\r\n")
+    body.append(b"--%s--\r\n" % rangeBoundary)
+    length = sum(part[2] if isinstance(part, tuple) else len(part) for part in body)
+    header = (b"HTTP/1.1 206 Partial Content\r\nContent-Type: multipart/byteranges; boundary=%s\r\n"
+              b"Content-Length: %d\r\n%s" % (rangeBoundary, length, entry.validators))
+    return [header, connection] + body
+
+
+# Encodings from Accept-Encoding that we can produce, in our order of preference
+def accepted_encodings(request):
+    qualities = {}
+    for item in request.headers.get('accept-encoding', '').split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+    default = qualities.get('*', 0.0)
+    return [encoding for encoding in serverEncodings if qualities.get(encoding, default) > 0]
+
+
+# Compresses a file version, caching the variant or remembering that it doesn't get any smaller
+def compress_variant(key, content, contentType):
+    _, mtime, _, encoding = key
+    compressed = serverEncodings[encoding][1](content)
+    if len(compressed) >= len(content):
+        skippedVariants.add(key)
+        return None
+    variant = FileEntry(compressed, mtime, len(compressed), contentType, encoding)
+    compressedCache.put(key, variant)
+    return variant
+
+
+# Worker thread side of compressing for the asyncio mode, the file is read again since the request is long done
+def compress_file(key, contentType):
+    fileName, mtime, size, _ = key
+    try:
+        with open(fileName, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            if stat.st_mtime_ns == mtime and stat.st_size == size: # not changed since
+                compress_variant(key, file.read(), contentType)
+    except OSError:
+        pass
+    finally:
+        compressing.discard(key)
+
+
+# Builds the gzip/br variant of a file, preferring a precompressed sibling (style.css.gz) on disk, and caches
+# what can be kept. Returns None when this encoding isn't worth it for the file or isn't ready yet.
+def load_variant(fileName, entry, encoding):
+    key = (fileName, entry.mtime, entry.size, encoding)
+    suffix, _ = serverEncodings[encoding]
+    try:
+        # The sibling could be a symlink, it has to stay inside the document root too
+        file = open(fileName + suffix, 'rb') if resolver.contains(os.path.realpath(fileName + suffix)) else None
+    except OSError:
+        file = None
+    if file is not None:
+        stat = os.fstat(file.fileno())
+        if stat.st_mtime_ns >= entry.mtime: # an older sibling is stale
+            if not compressedCache.accepts(stat.st_size):
+                return FileEntry(file, stat.st_mtime_ns, stat.st_size, entry.contentType, encoding)
+            with file:
+                content = file.read()
+            variant = FileEntry(content, stat.st_mtime_ns, len(content), entry.contentType, encoding)
+            compressedCache.put(key, variant)
+            return variant
+        file.close()
+
+    # Compress it ourselves, once per file version
+    if not compressedCache.maxBytes or not compressMinBytes <= entry.size <= compressMaxBytes:
+        skippedVariants.add(key)
+        return None
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError: # thread and process mode compress on the worker thread
+        loop = None
+    if loop is not None:
+        # Compressing megabytes would stall every connection on the event loop, this request gets the
+        # file as it is and the variant is there for the next ones
+        if key not in compressing:
+            compressing.add(key)
+            loop.run_in_executor(None, compress_file, key, entry.contentType)
+        return None
+    if isinstance(entry.body, bytes):
+        content = entry.body
+    else:
+        content = os.pread(entry.body.fileno(), entry.size, 0)
+    return compress_variant(key, content, entry.contentType)
+
+
+# The compressed variant of entry the client should get, or None to send the file as it is
+def encoded_entry(request, fileName, entry):
+    if 'accept-encoding' not in request.headers or not is_compressible(entry.contentType):
+        return None
+    for encoding in accepted_encodings(request):
+        key = (fileName, entry.mtime, entry.size, encoding)
+        variant = compressedCache.get(key)
+        if variant is None:
+            if key in skippedVariants:
+                continue
+            variant = load_variant(fileName, entry, encoding)
+            if variant is None:
+                continue
+        return variant
+    return None
+
+
+# Builds the HTTP response for a parsed request.
+# Returns a list of parts, each part is either bytes or a (file, offset, count) slice to stream.
+def build_response(request, keepAlive=False):
+    connection = connectionLines[keepAlive]
+
+    # Find the requested file under the document root
+    kind, fileName = resolver.resolve(request.path.split('?', 1)[0])
+    if kind == 'redirect':
+        return [b"HTTP/1.1 301 Moved Permanently\r\nLocation: %s\r\nContent-Length: 0\r\n" % fileName.encode(),
+                connection]
+
+    # Hot files are answered straight from memory
+    entry = fileCache.get(fileName) if fileCache.maxBytes and kind == 'file' else None
+    if entry is None:
+        # Handle File
+        try: #handle file, returns header + file slice
+            if kind != 'file':
+                raise FileNotFoundError
+            file = open(fileName, 'rb')
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError): #handle no file, returns HTML
+            content = b"<html><body><h1>404 Not Found</h1></body></html>"
+            header = b"HTTP/1.1 404 Not Found\r\nContent-Type: text/html\r\nContent-Length: %d\r\n" % len(content)
+            return [header, connection, content]
+        stat = os.fstat(file.fileno())
+        if fileCache.maxBytes and fileCache.accepts(stat.st_size):
+            with file:
+                content = file.read()
+            entry = FileEntry(content, stat.st_mtime_ns, len(content), content_type(fileName))
+            if len(content) == stat.st_size:
+                fileCache.put(fileName, entry)
+        else:
+            entry = FileEntry(file, stat.st_mtime_ns, stat.st_size, content_type(fileName))
+
+    # Text files go out compressed when the client accepts it
+    variant = encoded_entry(request, fileName, entry)
+    if variant is not None:
+        if not isinstance(entry.body, bytes):
+            entry.body.close()
+        entry = variant
+
+    parts = file_response(request, entry, connection)
+    if not isinstance(entry.body, bytes) and not any(isinstance(part, tuple) for part in parts):
+        entry.body.close() # 304/416 never touch the file
+    return parts
+
+
+# Picks the response for a request: the metrics endpoint for local clients, otherwise a file
+def route(request, keepAlive, addr):
+    if request.path == METRICS_PATH and is_local(addr):
+        gauges = {}
+        for cacheName, cache in (('file_cache', fileCache), ('compressed_cache', compressedCache)):
+            for stat, value in cache.stats().items():
+                gauges[f'{cacheName}_{stat}{{pid="{os.getpid()}"}}'] = value
+        return [metrics.response(gauges, keepAlive)]
+    parts = build_response(request, keepAlive)
+    if request.method == 'HEAD':
+        # Headers only, on a persistent connection a body would be read as the start of the next response
+        close_parts(parts[2:])
+        del parts[2:]
+    return parts
+
+
+# Total bytes in a response
+def parts_length(parts):
+    return sum(part[2] if isinstance(part, tuple) else len(part) for part in parts)
+
+
+# Records the counters, total time and access log line of a finished request
+def record_request(timer, request, parts, addr):
+    total = timer.finish()
+    status = int(parts[0][9:12])
+    sent = parts_length(parts)
+    metrics.count('requests_total')
+    metrics.count(f'responses_{status // 100}xx_total')
+    metrics.count('bytes_sent_total', sent)
+    accessLog.log(addr, request.request_line, status, sent, total)
+
+
+# Closes any files left open by a response
+def close_parts(parts):
+    for part in parts:
+        if isinstance(part, tuple):
+            part[0].close()
+
+
+# Reusable per-thread buffer for the readinto fallback, so large files never get read whole
+def get_send_buffer():
+    buffer = getattr(sendBuffers, 'buffer', None)
+    if buffer is None:
+        buffer = sendBuffers.buffer = memoryview(bytearray(sendBufferSize))
+    return buffer
+
+
+# Streams count bytes of file starting at offset, with os.sendfile when the platform has it
+def send_file(connectionSocket, file, offset, count):
+    if hasattr(os, 'sendfile'):
+        try:
+            while count > 0:
+                try:
+                    sent = os.sendfile(connectionSocket.fileno(), file.fileno(), offset, count)
+                except BlockingIOError: # socket has a timeout, wait until it is writable again
+                    if not select.select([], [connectionSocket], [], connectionSocket.gettimeout())[1]:
+                        raise TimeoutError("timed out sending file")
+                    continue
+                if sent == 0:
+                    raise ConnectionError("file ended before the promised Content-Length")
+                offset += sent
+                count -= sent
+            return
+        except OSError as e:
+            # Not supported for this file/socket pair, fall back to copying
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                raise
+
+    buffer = get_send_buffer()
+    file.seek(offset)
+    while count > 0:
+        read = file.readinto(buffer[:min(count, len(buffer))])
+        if not read:
+            raise ConnectionError("file ended before the promised Content-Length")
+        connectionSocket.sendall(buffer[:read])
+        count -= read
+
+
+# Sends several buffers with as few syscalls as possible, using scatter/gather sendmsg when available
+def send_buffers(connectionSocket, buffers):
+    if len(buffers) == 1 or not hasattr(connectionSocket, 'sendmsg'):
+        for buffer in buffers:
+            connectionSocket.sendall(buffer)
+        return
+    views = [memoryview(buffer) for buffer in buffers if buffer]
+    while views:
+        sent = connectionSocket.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+
+
+# Sends every part of a response on a blocking socket
+def send_parts(connectionSocket, parts):
+    buffers = []
+    for part in parts:
+        if isinstance(part, tuple):
+            send_buffers(connectionSocket, buffers)
+            buffers = []
+            send_file(connectionSocket, *part)
+        else:
+            buffers.append(part)
+    if buffers:
+        send_buffers(connectionSocket, buffers)
+
+
+# Serves the requests a client connection has sent on a blocking socket, once it has bytes to read.
+# Pipelined requests are answered in order straight out of the receive buffer. When the client has nothing
+# more buffered the connection is handed to park to wait for its next request, so it doesn't hold this thread.
+def handle_connection(connectionSocket, addr, acceptedAt, parser, served, park):
+    metrics.observe('accept_wait', time.perf_counter() - acceptedAt) # time spent queued for a free worker thread
+    try:
+        while served < maxKeepAliveRequests:
+            # Receive until a whole request is buffered, an idle timeout ends the connection
+            request = read_request(connectionSocket, parser)
+            if request is None:
+                return
+            timer = RequestTimer(metrics, request.started)
+            timer.mark('parse')
+
+            served += 1
+            keepAlive = request.keep_alive and served < maxKeepAliveRequests
+            parts = route(request, keepAlive, addr)
+            timer.mark('lookup')
+            try:
+                send_parts(connectionSocket, parts)
+            finally:
+                close_parts(parts)
+            timer.mark('send')
+            record_request(timer, request, parts, addr)
+            if not keepAlive:
+                return
+            if not parser.buffer:
+                park(connectionSocket, addr, parser, served)
+                connectionSocket = None
+                return
+    except timeout:
+        pass
+    except HttpParseError as e:
+        metrics.count(f'responses_{e.status // 100}xx_total')
+        connectionSocket.sendall(error_response(e))
+    except Exception as e:
+        print("Exception:", e)
+    finally:
+        if connectionSocket is not None:
+            connectionSocket.close()
+
+
+# Creates the listening socket. reusePort lets several processes bind the same port.
+def make_server_socket(port, backlog, reusePort=False):
+    serverSocket = socket(AF_INET, SOCK_STREAM)
+    serverSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reusePort:
+        serverSocket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    serverSocket.bind((serverIP, port))
+    serverSocket.listen(backlog)
+    return serverSocket
+
+
+# Waits on the listening socket and on every connection between requests with one selector, and hands a
+# connection to the pool of worker threads only once it has bytes to read. An idle keep-alive client then
+# costs a selector slot instead of a worker thread. Connections idle for keepAliveTimeout are closed, and so
+# are the longest idle ones beyond maxIdleConnections.
+class ConnectionPoller:
+    def __init__(self, serverSocket, pool):
+        self.serverSocket = serverSocket
+        self.pool = pool
+        self.selector = selectors.DefaultSelector()
+        self.idle = OrderedDict() # socket -> (addr, parser, requests served, deadline), longest idle first
+        self.parked = deque() # connections handed back by worker threads, registered by the poller thread
+        self.wakeup, self.waker = socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        serverSocket.setblocking(False)
+        self.selector.register(serverSocket, selectors.EVENT_READ)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+
+    # Called from a worker thread with a connection waiting for its next request
+    def park(self, connectionSocket, addr, parser, served):
+        self.parked.append((connectionSocket, addr, parser, served))
+        try:
+            self.waker.send(b"\0")
+        except BlockingIOError: # plenty of wakeups pending already
+            pass
+
+    def add(self, connectionSocket, addr, parser, served):
+        self.idle[connectionSocket] = (addr, parser, served, time.monotonic() + keepAliveTimeout)
+        self.selector.register(connectionSocket, selectors.EVENT_READ)
+        while len(self.idle) > maxIdleConnections:
+            self.close(next(iter(self.idle)))
+
+    def close(self, connectionSocket):
+        self.selector.unregister(connectionSocket)
+        del self.idle[connectionSocket]
+        connectionSocket.close()
+
+    def accept(self):
+        try:
+            connectionSocket, addr = self.serverSocket.accept()
+        except (BlockingIOError, InterruptedError): # another process took it
+            return
+        metrics.count('connections_total')
+        connectionSocket.settimeout(keepAliveTimeout)
+        self.add(connectionSocket, addr, RequestParser(), 0)
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.idle:
+                timeout = max(0, next(iter(self.idle.values()))[3] - time.monotonic())
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.serverSocket:
+                    self.accept()
+                elif key.fileobj is self.wakeup:
+                    try:
+                        self.wakeup.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    while self.parked:
+                        self.add(*self.parked.popleft())
+                elif key.fileobj in self.idle: # not closed for being over the limit meanwhile
+                    connectionSocket = key.fileobj
+                    addr, parser, served, _ = self.idle.pop(connectionSocket)
+                    self.selector.unregister(connectionSocket)
+                    self.pool.submit(handle_connection, connectionSocket, addr, time.perf_counter(), parser, served,
+                                     self.park)
+
+            # Idle clients that sent nothing for keepAliveTimeout
+            now = time.monotonic()
+            while self.idle and next(iter(self.idle.values()))[3] <= now:
+                self.close(next(iter(self.idle)))
+
+
+# Thread mode: a ConnectionPoller hands connections with requests to a pool of worker threads
+def serve_threaded(serverSocket, workers):
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        ConnectionPoller(serverSocket, pool).run()
+
+
+# Body of one process mode worker, it owns its own SO_REUSEPORT socket and metrics slot
+def process_worker(args, sharedMetrics, slot):
+    global metrics
+    apply_args(args)
+    metrics = sharedMetrics
+    metrics.slot = slot
+    serverSocket = make_server_socket(args.port, args.backlog, reusePort=True)
+    try:
+        serve_threaded(serverSocket, args.threads)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Worker", os.getpid(), "cache stats:", fileCache.stats(), flush=True)
+        serverSocket.close()
+
+
+# Process mode: the kernel spreads connections over worker processes sharing the port
+def serve_processes(args, workers):
+    # Every worker records into its own slot of one shared Metrics, so /__metrics shows all of them
+    sharedMetrics = Metrics('webserver', metricStages, metricCounters, slots=workers)
+    processes = [multiprocessing.Process(target=process_worker, args=(args, sharedMetrics, slot), daemon=True)
+                 for slot in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # Workers share the terminal's Ctrl-C, give them a moment to finish before forcing them
+        for process in processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+
+
+# Asyncio mode: sends every part of a response, files go through loop.sendfile
+async def send_parts_async(writer, parts):
+    loop = asyncio.get_running_loop()
+    for part in parts:
+        if isinstance(part, tuple):
+            await writer.drain()
+            file, offset, count = part
+            await loop.sendfile(writer.transport, file, offset, count)
+        else:
+            writer.write(part)
+    await writer.drain()
+
+
+# Asyncio mode: serves every request of a persistent client connection as a coroutine
+async def handle_client(reader, writer):
+    metrics.count('connections_total')
+    addr = writer.get_extra_info('peername')
+    parser = RequestParser()
+    served = 0
+    try:
+        while served < maxKeepAliveRequests:
+            try:
+                request = await asyncio.wait_for(read_request_async(reader, parser), keepAliveTimeout)
+            except asyncio.TimeoutError:
+                return
+            if request is None:
+                return
+            timer = RequestTimer(metrics, request.started)
+            timer.mark('parse')
+
+            served += 1
+            keepAlive = request.keep_alive and served < maxKeepAliveRequests
+            parts = route(request, keepAlive, addr)
+            timer.mark('lookup')
+            try:
+                await send_parts_async(writer, parts)
+            finally:
+                close_parts(parts)
+            timer.mark('send')
+            record_request(timer, request, parts, addr)
+            if not keepAlive:
+                return
+    except HttpParseError as e:
+        metrics.count(f'responses_{e.status // 100}xx_total')
+        writer.write(error_response(e))
+        await writer.drain()
+    except Exception as e:
+        print("Exception:", e)
+    finally:
+        writer.close()
+
+
+# Asyncio mode: every connection is multiplexed on a single event loop
+async def serve_asyncio(port, backlog):
+    server = await asyncio.start_server(handle_client, serverIP or None, port, backlog=backlog,
+                                        reuse_address=True)
+    async with server:
+        await server.serve_forever()
+
+
+# Reads the server options from the command line
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simple HTTP web server")
+    parser.add_argument('--port', type=int, default=serverPort)
+    parser.add_argument('--root', default=documentRoot, help="document root the files are served from")
+    parser.add_argument('--stat-ttl', type=float, default=statCacheTtl,
+                        help="seconds a path lookup, found or missing, is remembered")
+    parser.add_argument('--mode', choices=['thread', 'process', 'asyncio'], default='thread',
+                        help="concurrency model used to serve connections")
+    parser.add_argument('--workers', type=int, default=None,
+                        help=f"threads in thread mode (default {threadWorkers}), "
+                             f"processes in process mode (default {processWorkers})")
+    parser.add_argument('--threads', type=int, default=4, help="threads per process in process mode")
+    parser.add_argument('--backlog', type=int, default=serverBacklog, help="listen() backlog")
+    parser.add_argument('--keepalive-timeout', type=float, default=keepAliveTimeout,
+                        help="seconds an idle persistent connection is kept open")
+    parser.add_argument('--max-requests', type=int, default=maxKeepAliveRequests,
+                        help="requests served on one connection before it is closed")
+    parser.add_argument('--max-idle', type=int, default=maxIdleConnections,
+                        help="persistent connections kept open between requests in thread and process mode, "
+                             "the longest idle are closed beyond it")
+    parser.add_argument('--cache-size', type=int, default=cacheBytes // (1024 * 1024),
+                        help="MB of hot files kept in memory, 0 disables the cache")
+    parser.add_argument('--cache-max-file', type=int, default=cacheMaxFileBytes // 1024,
+                        help="KB, larger files are never cached")
+    parser.add_argument('--cache-check', type=float, default=cacheCheckInterval,
+                        help="seconds before a cached file is checked against the disk again")
+    parser.add_argument('--compress-cache', type=int, default=compressBytes // (1024 * 1024),
+                        help="MB of compressed variants kept in memory, 0 disables on-the-fly compression")
+    parser.add_argument('--access-log', default=None, help="file to write the access log to, - for stdout")
+    parser.add_argument('--log-sample', type=float, default=1.0, help="fraction of requests written to the access log")
+    return parser.parse_args()
+
+
+# Copies the tunables from the command line into the module settings.
+# Process mode workers call this again since they may not inherit the parent's globals.
+def apply_args(args):
+    global keepAliveTimeout, maxKeepAliveRequests, maxIdleConnections, fileCache, compressedCache, skippedVariants
+    global accessLog, resolver
+    keepAliveTimeout = args.keepalive_timeout
+    maxKeepAliveRequests = args.max_requests
+    maxIdleConnections = args.max_idle
+    fileCache = FileCache(args.cache_size * 1024 * 1024, args.cache_max_file * 1024, args.cache_check)
+    compressedCache = FileCache(args.compress_cache * 1024 * 1024, args.compress_cache * 1024 * 1024, float('inf'))
+    accessLog = AccessLog(args.access_log, args.log_sample)
+    resolver = PathResolver(args.root, args.stat_ttl, statCacheEntries)
+    skippedVariants = NegativeCache(args.stat_ttl, statCacheEntries)
+
+
+def main():
+    args = parse_args()
+    apply_args(args)
+    mode = args.mode
+    if mode == 'process' and 'SO_REUSEPORT' not in globals():
+        print("SO_REUSEPORT is not available on this platform, falling back to thread mode")
+        mode = 'thread'
+
+    print("The server is ready to receive! Listening on Port:", args.port, "Mode:", mode)
+    try:
+        if mode == 'thread':
+            serverSocket = make_server_socket(args.port, args.backlog)
+            serve_threaded(serverSocket, args.workers or threadWorkers)
+        elif mode == 'process':
+            serve_processes(args, args.workers or processWorkers)
+        else:
+            asyncio.run(serve_asyncio(args.port, args.backlog))
+    except KeyboardInterrupt:
+        print("Shutting down")
+        if mode != 'process':
+            print("Cache stats:", fileCache.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,176 +1,515 @@
-import dpkt
-import sys
-from dpkt.utils import inet_to_str
-
-
-# Reads a file from console and then opens the pcap file with dpkt
-def init_pcap_bytes():
-    file_name = sys.argv[1]
-    f = open(file_name, 'rb')
-    pcap_bytes = dpkt.pcap.Reader(f)
-    return pcap_bytes
-
-
-# Returns a set of flows for analysis
-def flow_info(pcap):
-    flows = {}
-    for timestamp, buf in pcap:
-        try:
-            # Unpack ethernet frame
-            eth = dpkt.ethernet.Ethernet(buf)
-
-            # Make sure the Ethernet frame contains an IP packet and TCP packet
-            if not isinstance(eth.data, dpkt.ip.IP):
-                continue
-            ip = eth.data
-            if not isinstance(ip.data, dpkt.tcp.TCP):
-                continue
-            tcp = ip.data
-
-            current_pkt = {
-                'syn': (eth.ip.data.flags & dpkt.tcp.TH_SYN),
-                'ack': (eth.ip.data.flags & dpkt.tcp.TH_ACK),
-                'fin': (eth.ip.data.flags & dpkt.tcp.TH_FIN),
-                'src': inet_to_str(ip.src),
-                'dst': inet_to_str(ip.dst),
-                'timestamp': timestamp,
-                'tcp': eth.ip.data,
-            }
-
-            # Flow identification part
-            # Key Tuple =  (source port, source IP address, destination port, destination IP address)
-            key = (tcp.sport, inet_to_str(ip.src), tcp.dport, inet_to_str(ip.dst))
-            alt_key = (tcp.dport, inet_to_str(ip.dst), tcp.sport, inet_to_str(ip.src))
-
-            # SYN Check for Flow Start
-            # We want the very first packet which means that it has the SYN flag but not an ACK flag
-            if (tcp.flags & dpkt.tcp.TH_SYN) and not (tcp.flags & dpkt.tcp.TH_ACK):
-                # Add key and initialize into flows if not in it
-                if key not in flows:
-                    flows[key] = {
-                        'start': timestamp,
-                        'end': 0,
-                        'packets': [current_pkt],
-                        'transmitted': {},
-                        'RTT': -timestamp,
-                        'congestion_window': [0, 0, 0],
-                        'ranges': [0, 0, 0, 0],
-                        'size': current_pkt['tcp'].opts[-1]
-                    }
-                else:
-                    flows[key]['packets'].append(current_pkt)
-            # FIN Check for Flow End
-            # We want the very last packet which means that it has the FIN flag. Also check to make sure its in flows.
-            elif tcp.flags & dpkt.tcp.TH_FIN and key in flows:
-                flows[key]['end'] = timestamp
-                flows[key]['packets'].append(current_pkt)
-            # Intermediate Packets, add to flow
-            elif key in flows:
-                if timestamp < flows[key]['start']:
-                    flows[key]['start'] = timestamp
-                flows[key]['packets'].append(current_pkt)
-                flows[key]['end'] = timestamp
-            # Reverse direction packets
-            else:
-                flows[alt_key]['packets'].append(current_pkt)
-
-            # RTT Determination
-            if (tcp.flags & dpkt.tcp.TH_SYN) and (tcp.flags & dpkt.tcp.TH_ACK):
-                if alt_key in flows:
-                    flows[alt_key]['RTT'] += timestamp
-
-            # Congestion Window Determination
-            if key in flows:
-                flow, trans = flows[key], flows[key]['transmitted']
-                for i in range(3):
-                    if flow['ranges'][i] <= timestamp <= flow['ranges'][i + 1]:
-                        flow['congestion_window'][i] += 1
-                if tcp.seq not in trans:
-                    trans[tcp.seq] = [[timestamp], 1]
-                elif tcp.flags & dpkt.tcp.TH_PUSH:
-                    for i in range(4):
-                        flow['ranges'][i] = timestamp + i * flow['RTT']
-                else:
-                    trans[tcp.seq][0].append(timestamp)
-                    trans[tcp.seq][1] += 1
-        except Exception:
-            continue
-    return flows
-
-
-# Helper Function to print our key items
-def key_printer(i, key):
-    print("--------------------------------------")
-    print(f"Flow {i + 1}: Source: ({key[1]}:{key[0]}) -> Destination: Source: ({key[3]}:{key[2]})")
-    print("The order below is Transaction 1 Sender -> Receiver then Transaction 2 Sender -> Receiver")
-    print("And then it is Transaction 1 Receiver -> Sender then Transaction 2 Receiver -> Sender")
-
-
-# Helper Function to print the direction of the packet movement
-def printer(sender, receiver, packet, rws):
-    print(f"{sender} -> {receiver}: SEQ: {packet.seq} ACK: {packet.ack} RWS: {rws}")
-
-
-# Helper Function to calculate and print throughput
-def byte_printer(packets, value, key):
-    # sums up the total bytes and then calculates the throughput
-    total_bytes = sum(len(packet['tcp']) for packet in packets if packet['src'] != key[3] or packet['dst'] != key[1])
-    print(
-        f"Total Bytes Sent: {total_bytes}, Duration: {value['end'] - value['start']}, Throughput: {total_bytes / (value['end'] - value['start'])}")
-
-
-# Helper Function to print retransmission statistics
-def retransmission_printer(packets, value):
-    # Time out and Duplicate Counters.
-    timeout_count = sum(
-        1 for packet in packets.values() if packet[1] > 1 and max(packet[0]) - min(packet[0]) > 2 * value['RTT'])
-    duplicate_count = sum(
-        1 for packet in packets.values() if packet[1] > 1 and not max(packet[0]) - min(packet[0]) > 2 * value['RTT'])
-    print(f"Retransmission Statistics: (Triple ACK Retransmissions: {duplicate_count}) + "
-          f"(Timeout Retransmissions: {timeout_count}) = (Total Retransmissions: {timeout_count + duplicate_count})")
-
-
-# Analyzes flows and determines
-def flows_analyzer(flow_list):
-    for i, (key, value) in enumerate(flow_list.items()):
-        stat_track = {
-            'send_count': 0,
-            'receive_count': 0,
-            'handshake_count': 0,
-            'receive_window_size': 0,
-        }
-        packets = sorted(value['packets'], key=lambda ft: ft['timestamp'])
-        for j, packet in enumerate(packets):
-            stat_track['receive_window_size'] = packet['tcp'].win << value['size']
-            # Begin the counting
-            if packet['syn']:
-                if packet['src'] == key[1] and packet['dst'] == key[3]:
-                    stat_track['handshake_count'] += 1
-                    key_printer(i, key)
-                elif packet['src'] == key[3] and packet['dst'] == key[1]:
-                    stat_track['handshake_count'] += 1
-            elif packet['ack'] and not packet['fin']:
-                # Sender to Receiver transaction
-                if packet['src'] == key[1] and packet['dst'] == key[3]:
-                    if not (2 <= stat_track['handshake_count'] <= 3):
-                        print("Bruh! Handshake was never completed!")
-                    elif stat_track['handshake_count'] == 2:
-                        stat_track['handshake_count'] += 1
-                    elif stat_track['handshake_count'] == 3:
-                        if stat_track['send_count'] < 2:
-                            printer("Sender", "Receiver", packet['tcp'], stat_track['receive_window_size'])
-                            stat_track['send_count'] += 1
-                # Receiver to Sender transaction
-                elif packet['src'] == key[3] and packet['dst'] == key[1]:
-                    if stat_track['receive_count'] < 2:
-                        printer("Receiver", "Sender", packet['tcp'], stat_track['receive_window_size'])
-                    stat_track['receive_count'] += 1
-            # When a fin is received, we will print the statistics of this flow
-            elif packet['fin']:
-                byte_printer(packets, value, key)
-                retransmission_printer(value['transmitted'], value)
-                print("Estimated Window Size:", value['congestion_window'])
-                break
-
-
-flows_analyzer(flow_info(init_pcap_bytes()))
+import argparse
+import dpkt
+import fast_decode
+import multiprocessing
+import sys
+from array import array
+from collections import OrderedDict
+from functools import partial
+from dpkt.utils import inet_to_str
+from pcap_reader import PcapReader
+try:
+    import flow_table
+except ImportError: # NumPy is optional, only --columnar needs it
+    flow_table = None
+
+
+# Maps the pcap or pcapng file given on the console into memory, frames are read straight out of the mapping
+def init_pcap_bytes(file_name):
+    return PcapReader(file_name)
+
+
+# Returns a set of flows for analysis
+def flow_info(pcap):
+    flows = {}
+    for timestamp, buf in pcap:
+        try:
+            # Unpack ethernet frame
+            eth = dpkt.ethernet.Ethernet(buf)
+
+            # Make sure the Ethernet frame contains an IP packet and TCP packet
+            if not isinstance(eth.data, dpkt.ip.IP):
+                continue
+            ip = eth.data
+            if not isinstance(ip.data, dpkt.tcp.TCP):
+                continue
+            tcp = ip.data
+
+            current_pkt = {
+                'syn': (eth.ip.data.flags & dpkt.tcp.TH_SYN),
+                'ack': (eth.ip.data.flags & dpkt.tcp.TH_ACK),
+                'fin': (eth.ip.data.flags & dpkt.tcp.TH_FIN),
+                'src': inet_to_str(ip.src),
+                'dst': inet_to_str(ip.dst),
+                'timestamp': timestamp,
+                'tcp': eth.ip.data,
+            }
+
+            # Flow identification part
+            # Key Tuple =  (source port, source IP address, destination port, destination IP address)
+            key = (tcp.sport, inet_to_str(ip.src), tcp.dport, inet_to_str(ip.dst))
+            alt_key = (tcp.dport, inet_to_str(ip.dst), tcp.sport, inet_to_str(ip.src))
+
+            # SYN Check for Flow Start
+            # We want the very first packet which means that it has the SYN flag but not an ACK flag
+            if (tcp.flags & dpkt.tcp.TH_SYN) and not (tcp.flags & dpkt.tcp.TH_ACK):
+                # Add key and initialize into flows if not in it
+                if key not in flows:
+                    flows[key] = {
+                        'start': timestamp,
+                        'end': 0,
+                        'packets': [current_pkt],
+                        'transmitted': {},
+                        'RTT': -timestamp,
+                        'congestion_window': [0, 0, 0],
+                        'ranges': [0, 0, 0, 0],
+                        'size': current_pkt['tcp'].opts[-1]
+                    }
+                else:
+                    flows[key]['packets'].append(current_pkt)
+            # FIN Check for Flow End
+            # We want the very last packet which means that it has the FIN flag. Also check to make sure its in flows.
+            elif tcp.flags & dpkt.tcp.TH_FIN and key in flows:
+                flows[key]['end'] = timestamp
+                flows[key]['packets'].append(current_pkt)
+            # Intermediate Packets, add to flow
+            elif key in flows:
+                if timestamp < flows[key]['start']:
+                    flows[key]['start'] = timestamp
+                flows[key]['packets'].append(current_pkt)
+                flows[key]['end'] = timestamp
+            # Reverse direction packets
+            else:
+                flows[alt_key]['packets'].append(current_pkt)
+
+            # RTT Determination
+            if (tcp.flags & dpkt.tcp.TH_SYN) and (tcp.flags & dpkt.tcp.TH_ACK):
+                if alt_key in flows:
+                    flows[alt_key]['RTT'] += timestamp
+
+            # Congestion Window Determination
+            if key in flows:
+                flow, trans = flows[key], flows[key]['transmitted']
+                for i in range(3):
+                    if flow['ranges'][i] <= timestamp <= flow['ranges'][i + 1]:
+                        flow['congestion_window'][i] += 1
+                if tcp.seq not in trans:
+                    trans[tcp.seq] = [[timestamp], 1]
+                elif tcp.flags & dpkt.tcp.TH_PUSH:
+                    for i in range(4):
+                        flow['ranges'][i] = timestamp + i * flow['RTT']
+                else:
+                    trans[tcp.seq][0].append(timestamp)
+                    trans[tcp.seq][1] += 1
+        except Exception:
+            continue
+    return flows
+
+
+# Helper Function to print our key items
+def key_printer(i, key):
+    print("--------------------------------------")
+    print(f"Flow {i + 1}: Source: ({key[1]}:{key[0]}) -> Destination: Source: ({key[3]}:{key[2]})")
+    print("The order below is Transaction 1 Sender -> Receiver then Transaction 2 Sender -> Receiver")
+    print("And then it is Transaction 1 Receiver -> Sender then Transaction 2 Receiver -> Sender")
+
+
+# Helper Function to print the direction of the packet movement
+def printer(sender, receiver, seq, ack, rws):
+    print(f"{sender} -> {receiver}: SEQ: {seq} ACK: {ack} RWS: {rws}")
+
+
+# Helper Function to calculate and print throughput
+def byte_printer(packets, value, key):
+    # sums up the total bytes and then calculates the throughput
+    total_bytes = sum(len(packet['tcp']) for packet in packets if packet['src'] != key[3] or packet['dst'] != key[1])
+    throughput_printer(total_bytes, value['end'] - value['start'])
+
+
+def throughput_printer(total_bytes, duration):
+    print(f"Total Bytes Sent: {total_bytes}, Duration: {duration}, Throughput: {total_bytes / duration}")
+
+
+# Helper Function to print retransmission statistics
+def retransmission_printer(packets, value):
+    # Time out and Duplicate Counters.
+    timeout_count = sum(
+        1 for packet in packets.values() if packet[1] > 1 and max(packet[0]) - min(packet[0]) > 2 * value['RTT'])
+    duplicate_count = sum(
+        1 for packet in packets.values() if packet[1] > 1 and not max(packet[0]) - min(packet[0]) > 2 * value['RTT'])
+    retransmission_count_printer(duplicate_count, timeout_count)
+
+
+def retransmission_count_printer(duplicate_count, timeout_count):
+    print(f"Retransmission Statistics: (Triple ACK Retransmissions: {duplicate_count}) + "
+          f"(Timeout Retransmissions: {timeout_count}) = (Total Retransmissions: {timeout_count + duplicate_count})")
+
+
+# Analyzes flows and determines
+def flows_analyzer(flow_list):
+    for i, (key, value) in enumerate(flow_list.items()):
+        stat_track = {
+            'send_count': 0,
+            'receive_count': 0,
+            'handshake_count': 0,
+            'receive_window_size': 0,
+        }
+        packets = sorted(value['packets'], key=lambda ft: ft['timestamp'])
+        for j, packet in enumerate(packets):
+            stat_track['receive_window_size'] = packet['tcp'].win << value['size']
+            # Begin the counting
+            if packet['syn']:
+                if packet['src'] == key[1] and packet['dst'] == key[3]:
+                    stat_track['handshake_count'] += 1
+                    key_printer(i, key)
+                elif packet['src'] == key[3] and packet['dst'] == key[1]:
+                    stat_track['handshake_count'] += 1
+            elif packet['ack'] and not packet['fin']:
+                # Sender to Receiver transaction
+                if packet['src'] == key[1] and packet['dst'] == key[3]:
+                    if not (2 <= stat_track['handshake_count'] <= 3):
+                        print("Bruh! Handshake was never completed!")
+                    elif stat_track['handshake_count'] == 2:
+                        stat_track['handshake_count'] += 1
+                    elif stat_track['handshake_count'] == 3:
+                        if stat_track['send_count'] < 2:
+                            printer("Sender", "Receiver", packet['tcp'].seq, packet['tcp'].ack,
+                                    stat_track['receive_window_size'])
+                            stat_track['send_count'] += 1
+                # Receiver to Sender transaction
+                elif packet['src'] == key[3] and packet['dst'] == key[1]:
+                    if stat_track['receive_count'] < 2:
+                        printer("Receiver", "Sender", packet['tcp'].seq, packet['tcp'].ack,
+                                stat_track['receive_window_size'])
+                    stat_track['receive_count'] += 1
+            # When a fin is received, we will print the statistics of this flow
+            elif packet['fin']:
+                byte_printer(packets, value, key)
+                retransmission_printer(value['transmitted'], value)
+                print("Estimated Window Size:", value['congestion_window'])
+                break
+
+
+# Fields of one TCP segment for the streaming analysis, None when the frame doesn't carry TCP over IP.
+# Addresses are integers, wscale is the last byte of the TCP options, which is what flow_info takes as
+# the window scale of a SYN. fast_decode.decode_segment gives the same without building dpkt objects.
+def dpkt_segment(buf):
+    eth = dpkt.ethernet.Ethernet(buf)
+    ip = eth.data
+    if not isinstance(ip, dpkt.ip.IP) or not isinstance(ip.data, dpkt.tcp.TCP):
+        return None
+    tcp = ip.data
+    return (int.from_bytes(ip.src, 'big'), tcp.sport, int.from_bytes(ip.dst, 'big'), tcp.dport, tcp.flags, tcp.seq,
+            tcp.ack, tcp.win, len(tcp), tcp.opts[-1] if tcp.opts else None)
+
+
+# Decoders of --decoder, the fast one falls back to dpkt for frames it doesn't handle
+DECODERS = {
+    'fast': partial(fast_decode.decode_segment, fallback=dpkt_segment),
+    'dpkt': dpkt_segment,
+}
+
+
+# Flow key with the addresses printable
+def display_key(key):
+    return key[0], inet_to_str(key[1].to_bytes(4, 'big')), key[2], inet_to_str(key[3].to_bytes(4, 'big'))
+
+
+# State of one flow in streaming mode: the running totals of flow_info, the counters of flows_analyzer
+# and what flows_analyzer would print so far
+def new_flow(number, key, timestamp, wscale):
+    return {
+        'number': number,
+        'key': key,
+        'start': timestamp,
+        'end': 0,
+        'last_seen': timestamp,
+        'RTT': -timestamp,
+        'size': wscale,
+        'bytes': 0,
+        'transmitted': OrderedDict(), # seq -> [first send, last send, sends] until the flow ends, see MAX_SEGMENTS
+        'timeouts': 0,
+        'duplicates': 0,
+        'congestion_window': [0, 0, 0],
+        'ranges': [0, 0, 0, 0],
+        'handshake_count': 0,
+        'send_count': 0,
+        'receive_count': 0,
+        'fin_seen': False, # flows_analyzer stops at the first FIN and prints the statistics
+        'fins': set(), # directions that sent a FIN
+        'report': [], # [event, times] in the order flows_analyzer prints them
+    }
+
+
+# Adds a line to the report of a flow, a line repeating the last one only counts it
+def report_line(flow, event):
+    report = flow['report']
+    if report and report[-1][0] == event:
+        report[-1][1] += 1
+    else:
+        report.append([event, 1])
+
+
+# Classifies the retransmissions of the oldest segments of a flow the way retransmission_printer does and forgets
+# them, until keep are left
+def settle_segments(flow, keep=0):
+    transmitted = flow['transmitted']
+    while len(transmitted) > keep:
+        first, last, sends = transmitted.popitem(last=False)[1]
+        if sends > 1:
+            if last - first > 2 * flow['RTT']:
+                flow['timeouts'] += 1
+            else:
+                flow['duplicates'] += 1
+
+
+# The part of flows_analyzer for one packet: the handshake and the first two transactions each way
+def observe_packet(flow, src, dst, flags, seq, ack, win):
+    if flow['fin_seen']:
+        return
+    key = flow['key']
+    rws = win << flow['size']
+    from_sender = src == key[1] and dst == key[3]
+    from_receiver = src == key[3] and dst == key[1]
+    if flags & dpkt.tcp.TH_SYN:
+        if from_sender:
+            flow['handshake_count'] += 1
+            report_line(flow, ('header',))
+        elif from_receiver:
+            flow['handshake_count'] += 1
+    elif flags & dpkt.tcp.TH_ACK and not flags & dpkt.tcp.TH_FIN:
+        if from_sender:
+            if not (2 <= flow['handshake_count'] <= 3):
+                report_line(flow, ('incomplete',))
+            elif flow['handshake_count'] == 2:
+                flow['handshake_count'] += 1
+            elif flow['send_count'] < 2:
+                report_line(flow, ('transaction', "Sender", "Receiver", seq, ack, rws))
+                flow['send_count'] += 1
+        elif from_receiver:
+            if flow['receive_count'] < 2:
+                report_line(flow, ('transaction', "Receiver", "Sender", seq, ack, rws))
+            flow['receive_count'] += 1
+    elif flags & dpkt.tcp.TH_FIN:
+        flow['fin_seen'] = True
+
+
+# Most segments a flow remembers, the oldest are settled beyond that. Like flow_info, a flow needs every segment
+# it sent to tell a retransmission (or a push that moves the packets per RTT windows) from a new segment.
+MAX_SEGMENTS = 65536
+
+
+# Streaming counterpart of flow_info and flows_analyzer. Each packet updates the state of its flow and a flow
+# is handed out as soon as it is over, so memory holds the open flows rather than the whole capture.
+# A flow is over after a RST, after the packet following FINs from both sides (the last ACK), or once
+# idle_timeout seconds of capture time pass without a packet. Flows come out in the order they end.
+# Unlike flow_info, packets after the end of a flow are ignored, and a flow only remembers its last MAX_SEGMENTS
+# segments.
+# decode turns a frame into the fields of dpkt_segment. Flows are numbered 1, 2, ... as they open, or with what
+# number() returns when a flow opens if it is given.
+def stream_flows(pcap, idle_timeout, decode=dpkt_segment, number=None):
+    flows = OrderedDict() # key -> flow, least recently active first
+    count = 0
+    for timestamp, buf in pcap:
+        try:
+            segment = decode(buf)
+        except Exception:
+            continue
+        if segment is None:
+            continue
+        src, sport, dst, dport, flags, seq, ack, win, length, wscale = segment
+        key = (sport, src, dport, dst)
+        alt_key = (dport, dst, sport, src)
+
+        # Flows that went quiet are over
+        while flows:
+            oldest = next(iter(flows.values()))
+            if timestamp - oldest['last_seen'] <= idle_timeout:
+                break
+            del flows[oldest['key']]
+            settle_segments(oldest)
+            yield oldest
+
+        # Same flow identification as flow_info
+        if (flags & dpkt.tcp.TH_SYN) and not (flags & dpkt.tcp.TH_ACK):
+            if key not in flows:
+                if wscale is None:
+                    continue
+                count += 1
+                flows[key] = new_flow(number() if number else count, key, timestamp, wscale)
+            flow, sending = flows[key], True
+        elif key in flows:
+            flow, sending = flows[key], True
+            if not flags & dpkt.tcp.TH_FIN and timestamp < flow['start']:
+                flow['start'] = timestamp
+            flow['end'] = timestamp
+        elif alt_key in flows:
+            flow, sending = flows[alt_key], False
+        else:
+            continue
+
+        # RTT Determination
+        if (flags & dpkt.tcp.TH_SYN) and (flags & dpkt.tcp.TH_ACK) and not sending:
+            flow['RTT'] += timestamp
+
+        # Bytes sent, counted like byte_printer does
+        if src != flow['key'][3] or dst != flow['key'][1]:
+            flow['bytes'] += length
+
+        # Congestion Window Determination
+        if sending:
+            for i in range(3):
+                if flow['ranges'][i] <= timestamp <= flow['ranges'][i + 1]:
+                    flow['congestion_window'][i] += 1
+            sent = flow['transmitted'].get(seq)
+            if sent is None:
+                flow['transmitted'][seq] = [timestamp, timestamp, 1]
+                if len(flow['transmitted']) > MAX_SEGMENTS:
+                    settle_segments(flow, MAX_SEGMENTS)
+            elif flags & dpkt.tcp.TH_PUSH:
+                for i in range(4):
+                    flow['ranges'][i] = timestamp + i * flow['RTT']
+            else:
+                sent[0] = min(sent[0], timestamp)
+                sent[1] = max(sent[1], timestamp)
+                sent[2] += 1
+
+        observe_packet(flow, src, dst, flags, seq, ack, win)
+
+        # End of the flow
+        if flags & dpkt.tcp.TH_RST or (len(flow['fins']) == 2 and not flags & dpkt.tcp.TH_FIN):
+            del flows[flow['key']]
+            settle_segments(flow)
+            yield flow
+            continue
+        if flags & dpkt.tcp.TH_FIN:
+            flow['fins'].add(sending)
+        flow['last_seen'] = timestamp
+        flows.move_to_end(flow['key'])
+
+    # Whatever is left ended with the capture
+    for flow in sorted(flows.values(), key=lambda flow: flow['number']):
+        settle_segments(flow)
+        yield flow
+
+
+# Prints what flows_analyzer prints for a flow that stream_flows handed out
+def flow_report(flow):
+    for event, times in flow['report']:
+        for _ in range(times):
+            if event[0] == 'header':
+                key_printer(flow['number'] - 1, display_key(flow['key']))
+            elif event[0] == 'incomplete':
+                print("Bruh! Handshake was never completed!")
+            else:
+                printer(*event[1:])
+    if flow['fin_seen']:
+        throughput_printer(flow['bytes'], flow['end'] - flow['start'])
+        retransmission_count_printer(flow['duplicates'], flow['timeouts'])
+        print("Estimated Window Size:", flow['congestion_window'])
+
+
+# First pass of the parallel analysis, in a worker: decodes the records in [start, end) of the file and sorts their
+# offsets into one bucket per worker by flow. Both directions of a connection hash to the same bucket.
+# Returns the buckets and where the walk of the records stopped, see PcapReader.range_end.
+def index_range(file_name, start, end, workers, decoder):
+    decode = DECODERS[decoder]
+    buckets = [array('Q') for _ in range(workers)]
+    with init_pcap_bytes(file_name) as pcap:
+        for offset, _, buf in pcap.records(start, end):
+            try:
+                segment = decode(buf)
+            except Exception:
+                continue
+            if segment is None:
+                continue
+            src, sport, dst, dport = segment[:4]
+            ends = (src, sport), (dst, dport)
+            buckets[hash(min(ends) + max(ends)) % workers].append(offset)
+        return buckets, pcap.range_end(start, end)
+
+
+# Second pass of the parallel analysis, in a worker: the streaming analysis of the packets at offsets, all the
+# packets of the flows of one bucket in capture order. Flows are numbered with the offset of the packet that opens them.
+def analyze_shard(file_name, offsets, idle_timeout, decoder):
+    current = [0]
+
+    def records():
+        for offset, record in zip(offsets, pcap.records_at(offsets)):
+            current[0] = offset
+            yield record
+
+    with init_pcap_bytes(file_name) as pcap:
+        return list(stream_flows(records(), idle_timeout, DECODERS[decoder], lambda: current[0]))
+
+
+# Streaming analysis spread over worker processes. The capture is cut into byte ranges of whole records that are
+# indexed in parallel, then each worker analyzes the flows that hash to it. Flows are handed out in the order
+# they opened and numbered like a single pass numbers them.
+# The first range starts at the first record, so when the walk of each range stops exactly at the bound of the next
+# one, all the bounds are record boundaries. If one isn't, the capture is split again reading every record header.
+def parallel_flows(file_name, workers, idle_timeout, decoder):
+    def index(exact):
+        with init_pcap_bytes(file_name) as pcap:
+            bounds = pcap.split(workers, exact)
+        ranges = pool.starmap(index_range, [(file_name, bounds[i], bounds[i + 1], workers, decoder)
+                                            for i in range(workers)])
+        return ranges if exact or all(stop == bounds[i + 1] for i, (_, stop) in enumerate(ranges[:-1])) else None
+
+    with multiprocessing.Pool(workers) as pool:
+        ranges = index(False) or index(True)
+        shards = []
+        for i in range(workers):
+            shard = array('Q')
+            for buckets, _ in ranges:
+                shard.extend(buckets[i])
+            shards.append((file_name, shard, idle_timeout, decoder))
+        flows = [flow for shard in pool.starmap(analyze_shard, shards) for flow in shard]
+    flows.sort(key=lambda flow: flow['number'])
+    for number, flow in enumerate(flows, 1):
+        flow['number'] = number
+    return flows
+
+
+# Command line options
+def parse_args():
+    arg_parser = argparse.ArgumentParser(description="TCP flow analysis of a pcap file")
+    arg_parser.add_argument('file_name', help="pcap file to analyze")
+    arg_parser.add_argument('--stream', action='store_true',
+                            help="analyze in a single pass, reporting each flow as soon as it ends, "
+                                 "memory then grows with the open flows instead of the capture")
+    arg_parser.add_argument('--decoder', choices=sorted(DECODERS), default='fast',
+                            help="with --stream, --workers or --columnar, how headers are decoded: fast reads "
+                                 "the fields with struct and leaves unusual frames to dpkt")
+    arg_parser.add_argument('--idle-timeout', type=float, default=60.0,
+                            help="with --stream or --workers, seconds of capture time after which a silent flow "
+                                 "is reported")
+    arg_parser.add_argument('--columnar', action='store_true',
+                            help="load the TCP headers into NumPy arrays and compute the flow metrics with "
+                                 "vectorized group-by operations (needs NumPy)")
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help="run the streaming analysis in this many processes, each one analyzing the flows "
+                                 "that hash to it; flows are then reported in the order they opened")
+    return arg_parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with init_pcap_bytes(args.file_name) as pcap:
+        if args.columnar:
+            if flow_table is None:
+                sys.exit("--columnar needs NumPy: pip install numpy")
+            for flow in flow_table.flows(flow_table.packet_table(pcap, DECODERS[args.decoder])):
+                flow_report(flow)
+        elif args.workers > 1:
+            for flow in parallel_flows(args.file_name, args.workers, args.idle_timeout, args.decoder):
+                flow_report(flow)
+        elif args.stream:
+            for flow in stream_flows(pcap, args.idle_timeout, DECODERS[args.decoder]):
+                flow_report(flow)
+        else:
+            flows_analyzer(flow_info(pcap))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+'''
+Packets/second of analysis_pcap_tcp.py's header decoders.
+Reads a capture into memory once, then times each decoder on every frame and the whole streaming
+analysis with each of them, and prints the results as JSON. The decoders have to agree on every
+frame, the frames where they don't are counted in the report.
+
+Example: python benchmark.py assignment2.pcap --repeat 5
+'''
+import argparse
+import json
+import time
+import analysis_pcap_tcp as analysis
+
+
+def load_frames(file_name):
+    '''
+    [(timestamp, frame)] of the whole capture, read before timing starts. The frames are views into the
+    mapped file, which stays mapped as long as they are referenced.
+    '''
+    return list(analysis.init_pcap_bytes(file_name))
+
+
+def decode_all(decode, frames):
+    for _, buf in frames:
+        try:
+            decode(buf)
+        except Exception:
+            pass
+
+
+def analyze_all(decode, frames, idle_timeout):
+    for _ in analysis.stream_flows(frames, idle_timeout, decode):
+        pass
+
+
+def best_rate(run, packets, repeat):
+    '''
+    Packets/second of the fastest of repeat runs
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - started)
+    return round(packets / best) if best else 0
+
+
+def mismatches(frames):
+    '''
+    Frames the decoders decode differently
+    '''
+    count = 0
+    for _, buf in frames:
+        results = set()
+        for decode in analysis.DECODERS.values():
+            try:
+                results.add(decode(buf))
+            except Exception as e:
+                results.add(type(e))
+        count += len(results) > 1
+    return count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark of the pcap header decoders")
+    parser.add_argument('file_name', help="pcap file to decode")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each measurement, the fastest counts")
+    parser.add_argument('--idle-timeout', type=float, default=60.0, help="idle timeout of the streaming analysis")
+    parser.add_argument('--output', help="also write the JSON report to this file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    frames = load_frames(args.file_name)
+    packets = len(frames)
+    summary = {'file': args.file_name, 'packets': packets, 'decode_pps': {}, 'analysis_pps': {}}
+    for name, decode in analysis.DECODERS.items():
+        summary['decode_pps'][name] = best_rate(lambda: decode_all(decode, frames), packets, args.repeat)
+        summary['analysis_pps'][name] = best_rate(lambda: analyze_all(decode, frames, args.idle_timeout),
+                                                  packets, args.repeat)
+    if summary['decode_pps'].get('dpkt'):
+        summary['decode_speedup'] = round(summary['decode_pps']['fast'] / summary['decode_pps']['dpkt'], 2)
+        summary['analysis_speedup'] = round(summary['analysis_pps']['fast'] / summary['analysis_pps']['dpkt'], 2)
+    summary['mismatches'] = mismatches(frames)
+
+    report = json.dumps(summary, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
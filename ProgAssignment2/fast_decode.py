@@ -0,0 +1,49 @@
+'''
+Fast path for the header decoding of analysis_pcap_tcp.py's streaming mode.
+Reads the few fields the analysis needs straight out of an Ethernet frame with precompiled
+structs, instead of building dpkt Ethernet, IP and TCP objects and formatting addresses for every
+packet. Addresses stay integers. Frames it doesn't handle itself (VLAN tags, IP fragments,
+truncated or malformed headers) go to a fallback decoder, so the result is always what dpkt gives.
+'''
+import struct
+
+ETHERNET_HEADER = 14
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+IP_PROTO_TCP = 6
+
+ETHERTYPE = struct.Struct('!H') # at offset 12
+# version/IHL, total length, flags/fragment offset, protocol, source, destination
+IPV4 = struct.Struct('!BxHxxHxBxxII')
+# ports, seq, ack, data offset/flags, window
+TCP = struct.Struct('!HHIIHH')
+
+
+def decode_segment(buf, fallback):
+    '''
+    (src, sport, dst, dport, flags, seq, ack, win, tcp length, last option byte or None) of a frame,
+    None when it doesn't carry TCP over IPv4. Anything unusual is decoded by fallback(buf) instead.
+    '''
+    if len(buf) < ETHERNET_HEADER + IPV4.size:
+        return fallback(buf)
+    ethertype, = ETHERTYPE.unpack_from(buf, 12)
+    if ethertype != ETHERTYPE_IPV4:
+        return None if ethertype == ETHERTYPE_IPV6 else fallback(buf)
+
+    version_ihl, total_length, fragment, protocol, src, dst = IPV4.unpack_from(buf, ETHERNET_HEADER)
+    ip_header = (version_ihl & 0xf) << 2
+    if version_ihl >> 4 != 4 or ip_header < IPV4.size or fragment & 0x3fff:
+        return fallback(buf)
+    if protocol != IP_PROTO_TCP:
+        return None
+    tcp_start = ETHERNET_HEADER + ip_header
+    tcp_length = total_length - ip_header
+    if tcp_length < TCP.size + 4 or ETHERNET_HEADER + total_length > len(buf):
+        return fallback(buf)
+
+    sport, dport, seq, ack, offset_flags, win = TCP.unpack_from(buf, tcp_start)
+    tcp_header = (offset_flags >> 12) << 2
+    if tcp_header < 20 or tcp_header > tcp_length:
+        return fallback(buf)
+    wscale = buf[tcp_start + tcp_header - 1] if tcp_header > 20 else None
+    return src, sport, dst, dport, offset_flags & 0x1ff, seq, ack, win, tcp_length, wscale
@@ -0,0 +1,231 @@
+'''
+Columnar packet table and vectorized flow metrics for analysis_pcap_tcp.py.
+The TCP header fields of a capture are loaded into NumPy arrays, one per field, and what flow_info and
+flows_analyzer report for every flow (throughput, RTT, retransmissions, packets per RTT and the first
+transactions) is computed with sorts and group-by reductions over them instead of Python loops over dicts.
+NumPy is optional, analysis_pcap_tcp.py only needs this module for --columnar.
+'''
+from array import array
+
+import dpkt
+import numpy as np
+
+# Fields of a decoded segment, see analysis_pcap_tcp.dpkt_segment
+FIELDS = ('src', 'sport', 'dst', 'dport', 'flags', 'seq', 'ack', 'win', 'length', 'wscale')
+
+
+def packet_table(pcap, decode):
+    '''
+    {field: array} of the TCP segments of a capture in capture order, decoded with decode, plus their timestamps.
+    A missing window scale is -1.
+    '''
+    # One growing array per field, so each packet costs 8 bytes a field rather than a tuple of ints
+    columns = [array('q') for _ in FIELDS]
+    timestamps = array('d')
+    for timestamp, buf in pcap:
+        try:
+            segment = decode(buf)
+        except Exception:
+            continue
+        if segment is None:
+            continue
+        timestamps.append(timestamp)
+        for column, value in zip(columns, segment):
+            column.append(-1 if value is None else value)
+    table = {field: np.frombuffer(column, dtype=np.int64) for field, column in zip(FIELDS, columns)}
+    table['timestamp'] = np.frombuffer(timestamps, dtype=np.float64)
+    return table
+
+
+def group_firsts(groups):
+    '''
+    For rows sorted by group, the position of the first row of each row's group
+    '''
+    positions = np.arange(len(groups))
+    starts = np.ones(len(groups), dtype=bool)
+    starts[1:] = groups[1:] != groups[:-1]
+    return np.maximum.accumulate(np.where(starts, positions, 0))
+
+
+def running_count(mask, firsts):
+    '''
+    For rows sorted by group, how many rows of the same group before each row are set in mask
+    '''
+    before = np.cumsum(mask) - mask
+    return before - before[firsts]
+
+
+def first_position(groups, mask, count, default):
+    '''
+    Smallest row position per group among the rows set in mask, default for groups without one
+    '''
+    first = np.full(count, default)
+    np.minimum.at(first, groups[mask], np.flatnonzero(mask))
+    return first
+
+
+def flows(table):
+    '''
+    The flows of a packet table in the order they opened, as dicts analysis_pcap_tcp.flow_report prints.
+    Flows and their packets are identified like flow_info does it.
+    '''
+    timestamps = table['timestamp']
+    packets = len(timestamps)
+    if not packets:
+        return []
+    index = np.arange(packets)
+    flags = table['flags']
+    syn = flags & dpkt.tcp.TH_SYN != 0
+    ack = flags & dpkt.tcp.TH_ACK != 0
+    fin = flags & dpkt.tcp.TH_FIN != 0
+    push = flags & dpkt.tcp.TH_PUSH != 0
+    src, dst = table['src'], table['dst']
+
+    # Ids of the (sport, src, dport, dst) key of each packet and of the key of the other direction, from ids
+    # of the (address, port) ends, which fit in one integer
+    ends, end_ids = np.unique(np.concatenate([src << 16 | table['sport'], dst << 16 | table['dport']]),
+                              return_inverse=True)
+    source, destination = end_ids[:packets], end_ids[packets:]
+    keys, ids = np.unique(np.concatenate([source * len(ends) + destination, destination * len(ends) + source]),
+                          return_inverse=True)
+    key, alt_key = ids[:packets], ids[packets:]
+
+    # A flow opens with the first SYN without ACK of its key that has options. Its packets are those of the key
+    # once it has opened, and those of the other direction that aren't SYNs opening something else.
+    opening = syn & ~ack & (table['wscale'] >= 0)
+    opened = np.full(len(keys), packets)
+    np.minimum.at(opened, key[opening], index[opening])
+    sending = opened[key] <= index
+    receiving = ~sending & (opened[alt_key] <= index) & ~(syn & ~ack)
+    flow_keys = np.flatnonzero(opened < packets)
+    flow_keys = flow_keys[np.argsort(opened[flow_keys], kind='stable')]
+    count = len(flow_keys)
+    if not count:
+        return []
+    number = np.full(len(keys), -1)
+    number[flow_keys] = np.arange(count)
+    flow = np.where(sending, number[key], np.where(receiving, number[alt_key], -1))
+    first = opened[flow_keys]
+    sender, receiver = src[first], dst[first]
+
+    # Start and end: packets of the sender other than SYNs without ACK, FINs only move the end
+    moving = sending & ~(syn & ~ack)
+    last = np.full(count, -1)
+    np.maximum.at(last, flow[moving], index[moving])
+    end = np.where(last >= 0, timestamps[last], 0.0)
+    start = timestamps[first].copy()
+    np.minimum.at(start, flow[moving & ~fin], timestamps[moving & ~fin])
+
+    # Bytes of every packet not going from the receiver's address to the sender's
+    counted = (flow >= 0) & ~((src == receiver[flow]) & (dst == sender[flow]))
+    sent = np.zeros(count, dtype=np.int64)
+    np.add.at(sent, flow[counted], table['length'][counted])
+
+    # RTT: the SYN/ACKs answering a flow minus its opening SYN, summed in capture order one term per flow at a time
+    # so the sums are those of flow_info, along with the RTT known after each term
+    opener = opening & (opened[key] == index)
+    answer = syn & ack & (opened[alt_key] <= index)
+    target = np.where(opener, number[key], np.where(answer, number[alt_key], -1))
+    timed = np.flatnonzero(target >= 0)
+    order = np.argsort(target[timed], kind='stable')
+    term_flow, term_index = target[timed][order], timed[order]
+    terms = np.where(opener, -timestamps, timestamps)[term_index]
+    rank = np.arange(len(order)) - group_firsts(term_flow)
+    rtt, known = np.zeros(count), np.empty(len(order))
+    for i in range(rank.max() + 1):
+        step = rank == i
+        rtt[term_flow[step]] += terms[step]
+        known[step] = rtt[term_flow[step]]
+    term_keys = term_flow * packets + term_index
+
+    # Segments of the sender grouped by (flow, seq), the first send of each is fresh
+    outgoing = np.flatnonzero(sending)
+    out_flow, out_time, out_push = flow[outgoing], timestamps[outgoing], push[outgoing]
+    out_seq = table['seq'][outgoing]
+    order = np.lexsort((outgoing, out_seq, out_flow))
+    new_segment = np.ones(len(order), dtype=bool)
+    new_segment[1:] = (out_flow[order][1:] != out_flow[order][:-1]) | (out_seq[order][1:] != out_seq[order][:-1])
+    fresh = np.empty(len(order), dtype=bool)
+    fresh[order] = new_segment
+
+    # Retransmissions: segments sent more than once, pushes of a known segment don't count as sends
+    kept = (fresh | ~out_push)[order]
+    starts = np.flatnonzero(new_segment)
+    sends = np.add.reduceat(kept.astype(np.int64), starts)
+    latest = np.maximum.reduceat(np.where(kept, out_time[order], -np.inf), starts)
+    earliest = np.minimum.reduceat(np.where(kept, out_time[order], np.inf), starts)
+    segment_flow = out_flow[order][starts]
+    resent = sends > 1
+    timed_out = resent & (latest - earliest > 2 * rtt[segment_flow])
+    timeouts = np.bincount(segment_flow[timed_out], minlength=count)
+    duplicates = np.bincount(segment_flow[resent & ~timed_out], minlength=count)
+
+    # Packets per RTT: a push of a known segment starts three windows as long as the RTT known then at its
+    # timestamp, every packet of the sender counts in the windows of the last push before it
+    order = np.argsort(out_flow, kind='stable')
+    rtt_then = known[np.searchsorted(term_keys, out_flow[order] * packets + outgoing[order], side='right') - 1]
+    window_flow, window_time = out_flow[order], out_time[order]
+    positions = np.arange(len(order))
+    moved = np.maximum.accumulate(np.where((~fresh & out_push)[order], positions, -1))
+    before = np.full(len(order), -1)
+    before[1:] = moved[:-1]
+    before[before < group_firsts(window_flow)] = -1
+    base = np.where(before >= 0, window_time[before], 0.0)
+    step = np.where(before >= 0, rtt_then[before], 0.0)
+    window = np.zeros((count, 3), dtype=np.int64)
+    for i in range(3):
+        inside = (base + i * step <= window_time) & (window_time <= base + (i + 1) * step)
+        window[:, i] = np.bincount(window_flow[inside], minlength=count)
+
+    # Report lines of flows_analyzer: its packets in timestamp order up to the first FIN
+    members = np.flatnonzero(flow >= 0)
+    rows = members[np.lexsort((timestamps[members], flow[members]))]
+    row_flow = flow[rows]
+    firsts = group_firsts(row_flow)
+    from_sender = (src[rows] == sender[row_flow]) & (dst[rows] == receiver[row_flow])
+    from_receiver = ~from_sender & (src[rows] == receiver[row_flow]) & (dst[rows] == sender[row_flow])
+    row_syn = syn[rows]
+    acked = ~row_syn & ack[rows] & ~fin[rows]
+    fin_row = first_position(row_flow, ~row_syn & fin[rows], count, len(rows))
+    live = np.arange(len(rows)) < fin_row[row_flow]
+    handshakes = running_count(row_syn & (from_sender | from_receiver) & live, firsts)
+    sender_acks = acked & from_sender & live
+    third = first_position(row_flow, sender_acks & (handshakes == 2), count, len(rows))
+    handshake = handshakes + (np.arange(len(rows)) > third[row_flow])
+    header = row_syn & from_sender & live
+    incomplete = sender_acks & ((handshake < 2) | (handshake > 3))
+    transactions = sender_acks & (handshake == 3)
+    transactions &= running_count(transactions, firsts) < 2
+    replies = acked & from_receiver & live
+    replies &= running_count(replies, firsts) < 2
+
+    reports = [[] for _ in range(count)]
+    shift = table['wscale'][first].tolist()
+    for row in np.flatnonzero(header | incomplete | transactions | replies).tolist():
+        packet, flow_number = rows[row], row_flow[row]
+        if header[row]:
+            event = ('header',)
+        elif incomplete[row]:
+            event = ('incomplete',)
+        else:
+            direction = ("Sender", "Receiver") if transactions[row] else ("Receiver", "Sender")
+            event = ('transaction', *direction, int(table['seq'][packet]), int(table['ack'][packet]),
+                     int(table['win'][packet]) << shift[flow_number])
+        reports[flow_number].append([event, 1])
+
+    flow_list = []
+    tuples = zip(table['sport'][first].tolist(), sender.tolist(), table['dport'][first].tolist(), receiver.tolist())
+    for i, flow_key in enumerate(tuples):
+        flow_list.append({
+            'number': i + 1,
+            'key': flow_key,
+            'start': float(start[i]),
+            'end': float(end[i]),
+            'bytes': int(sent[i]),
+            'timeouts': int(timeouts[i]),
+            'duplicates': int(duplicates[i]),
+            'congestion_window': window[i].tolist(),
+            'fin_seen': bool(fin_row[i] < len(rows)),
+            'report': reports[i],
+        })
+    return flow_list
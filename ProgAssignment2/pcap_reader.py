@@ -0,0 +1,287 @@
+'''
+Memory-mapped capture reader for analysis_pcap_tcp.py.
+The file is mapped once and every record is handed out as a memoryview into the mapping, so
+reading a capture copies nothing and needs no read() call per record. Classic pcap files in
+either byte order, with microsecond or nanosecond timestamps, and pcapng files are supported.
+Records come with their byte offset in the file, a scan can start at any record boundary, and
+split() cuts a file into ranges of whole records that can be scanned independently.
+'''
+import mmap
+import struct
+
+# Classic pcap magic numbers as read little-endian: (byte order, timestamp units per second)
+PCAP_MAGIC = {
+    0xa1b2c3d4: ('<', 1e6),
+    0xa1b23c4d: ('<', 1e9),
+    0xd4c3b2a1: ('>', 1e6),
+    0x4d3cb2a1: ('>', 1e9),
+}
+PCAP_HEADER = 24
+PCAP_RECORD = 16
+# Record headers that have to follow each other for an offset to be taken as a record boundary by resync,
+# the longest record it takes as plausible when the file has no snaplen and the shortest frame (an Ethernet header)
+RESYNC_RECORDS = 8
+MAX_CAPTURED = 262144
+MIN_FRAME = 14
+
+# pcapng block types
+SECTION_HEADER = 0x0A0D0D0A
+INTERFACE_DESCRIPTION = 0x00000001
+OBSOLETE_PACKET = 0x00000002
+SIMPLE_PACKET = 0x00000003
+ENHANCED_PACKET = 0x00000006
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+# Interface description options
+IF_TSRESOL = 9
+IF_TSOFFSET = 14
+
+
+class PcapReader:
+    '''
+    A pcap or pcapng file mapped into memory. Iterating gives (timestamp, frame) like dpkt.pcap.Reader.
+    Frames are memoryviews that are only valid while the reader is open.
+    '''
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = open(file_name, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # an empty file can't be mapped
+            self.file.close()
+            raise ValueError(f"{file_name} is not a pcap or pcapng file")
+        self.view = memoryview(self.map)
+        self.size = len(self.map)
+        magic, = struct.unpack_from('<I', self.map, 0) if self.size >= 4 else (None,)
+        if magic in PCAP_MAGIC and self.size >= PCAP_HEADER:
+            self.format = 'pcap'
+            self.byte_order, self.resolution = PCAP_MAGIC[magic]
+            self.snaplen, self.linktype = struct.unpack_from(self.byte_order + 'II', self.map, 16)
+            self.first_record = PCAP_HEADER
+            # resync takes no record as earlier than the first one
+            self.first_seconds = 0
+            if self.size >= PCAP_HEADER + PCAP_RECORD:
+                self.first_seconds, = struct.unpack_from(self.byte_order + 'I', self.map, PCAP_HEADER)
+        elif magic == SECTION_HEADER:
+            self.format = 'pcapng'
+            self.linktype = None # of the first interface, set once it has been read
+            self.first_record = 0
+        else:
+            self.close()
+            raise ValueError(f"{file_name} is not a pcap or pcapng file")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        for _, timestamp, frame in self.records():
+            yield timestamp, frame
+
+    def records(self, start=None, end=None):
+        '''
+        (offset, timestamp, frame) of the records that start at or after start and before end,
+        by default all of them. For classic pcap start has to be the offset of a record. pcapng
+        blocks are always walked from the beginning, which only reads their headers, since the
+        interfaces described before start are needed. A record cut off by the end of the file ends the scan.
+        '''
+        start = self.first_record if start is None else start
+        end = self.size if end is None else min(end, self.size)
+        if self.format == 'pcap':
+            return self.pcap_records(start, end)
+        return self.pcapng_records(max(start, self.first_record), end)
+
+    def pcap_records(self, start, end):
+        header = struct.Struct(self.byte_order + 'IIII')
+        unpack_from = header.unpack_from
+        view, size, resolution = self.view, self.size, self.resolution
+        offset = start
+        while offset < end and offset + PCAP_RECORD <= size:
+            seconds, fraction, captured, _ = unpack_from(view, offset)
+            data = offset + PCAP_RECORD
+            if data + captured > size:
+                return
+            yield offset, seconds + fraction / resolution, view[data:data + captured]
+            offset = data + captured
+
+    def records_at(self, offsets):
+        '''
+        (timestamp, frame) of the records at offsets, which have to be in increasing order.
+        pcapng has no way to look a record up, the blocks in between are walked.
+        '''
+        if self.format == 'pcap':
+            header = struct.Struct(self.byte_order + 'IIII')
+            unpack_from = header.unpack_from
+            view, resolution = self.view, self.resolution
+            for offset in offsets:
+                seconds, fraction, captured, _ = unpack_from(view, offset)
+                yield seconds + fraction / resolution, view[offset + PCAP_RECORD:offset + PCAP_RECORD + captured]
+            return
+        offsets = iter(offsets)
+        wanted = next(offsets, None)
+        if wanted is None:
+            return
+        for offset, timestamp, frame in self.records(wanted):
+            if offset == wanted:
+                yield timestamp, frame
+                wanted = next(offsets, None)
+                if wanted is None:
+                    return
+
+    def split(self, parts, exact=False):
+        '''
+        Offsets cutting the records into parts ranges of about the same number of bytes, from the first record to
+        the end of the file: range i is [offsets[i], offsets[i + 1]). Ranges can be empty.
+        The bounds of a classic pcap are found with resync, which can be fooled by frames that look like record
+        headers (range_end tells), unless exact is set: then every record header up to the last cut is read.
+        '''
+        cuts = [self.first_record + (self.size - self.first_record) * i // parts for i in range(1, parts)]
+        if self.format == 'pcap' and exact:
+            header = struct.Struct(self.byte_order + 'IIII')
+            bounds = []
+            offset = self.first_record
+            while len(bounds) < len(cuts) and offset + PCAP_RECORD <= self.size:
+                while len(bounds) < len(cuts) and offset >= cuts[len(bounds)]:
+                    bounds.append(offset)
+                offset += PCAP_RECORD + header.unpack_from(self.view, offset)[2]
+            bounds += [self.size] * (len(cuts) - len(bounds))
+        elif self.format == 'pcap':
+            bounds = [self.resync(cut) for cut in cuts]
+        else:
+            bounds = []
+            for offset, _, _, _ in self.blocks():
+                while len(bounds) < len(cuts) and offset >= cuts[len(bounds)]:
+                    bounds.append(offset)
+            bounds += [self.size] * (len(cuts) - len(bounds))
+        return [self.first_record] + bounds + [self.size]
+
+    def range_end(self, start, end):
+        '''
+        Offset where a walk of the records from start stops once it reaches end, the end of the file if a record
+        is cut off by it. When start is a record boundary, this is end exactly if end is one too.
+        pcapng bounds are always block boundaries, so a pcapng range ends at end.
+        '''
+        if self.format != 'pcap':
+            return end
+        header = struct.Struct(self.byte_order + 'IIII')
+        offset = start
+        while offset < end:
+            if offset + PCAP_RECORD > self.size:
+                return self.size
+            offset += PCAP_RECORD + header.unpack_from(self.view, offset)[2]
+        return min(offset, self.size)
+
+    def resync(self, offset):
+        '''
+        First record boundary of a classic pcap at or after offset, the end of the file if there is none.
+        Record headers carry no marker, a boundary is where RESYNC_RECORDS plausible headers follow each other
+        (or where plausible headers lead exactly to the end of the file). A plausible header holds at least an
+        Ethernet header's worth of frame and isn't older than the first record, so runs of zero bytes don't pass.
+        '''
+        offset = max(offset, self.first_record)
+        while offset < self.size:
+            if self.record_chain(offset):
+                return offset
+            offset += 1
+        return self.size
+
+    def record_chain(self, offset):
+        header = struct.Struct(self.byte_order + 'IIII')
+        longest = self.snaplen or MAX_CAPTURED
+        previous = None
+        for _ in range(RESYNC_RECORDS):
+            if offset == self.size:
+                return previous is not None
+            if offset + PCAP_RECORD > self.size:
+                return False
+            seconds, fraction, captured, original = header.unpack_from(self.view, offset)
+            if fraction >= self.resolution or captured > longest or captured > original or original > MAX_CAPTURED:
+                return False
+            if captured == 0 or original < MIN_FRAME or seconds < self.first_seconds:
+                return False
+            if previous is not None and abs(seconds - previous) > 86400:
+                return False
+            previous = seconds
+            offset += PCAP_RECORD + captured
+            if offset > self.size:
+                return False
+        return True
+
+    def blocks(self):
+        '''
+        (offset, block type, length, byte order) of the pcapng blocks, up to the first malformed or cut off one
+        '''
+        view, size = self.view, self.size
+        byte_order = '<' # set by each section header
+        block = struct.Struct(byte_order + 'II')
+        offset = 0
+        while offset + 12 <= size:
+            block_type, = struct.unpack_from('<I', view, offset)
+            if block_type == SECTION_HEADER: # a new section can change the byte order
+                magic, = struct.unpack_from('<I', view, offset + 8)
+                byte_order = '<' if magic == BYTE_ORDER_MAGIC else '>'
+                block = struct.Struct(byte_order + 'II')
+            block_type, length = block.unpack_from(view, offset)
+            if length < 12 or offset + length > size:
+                return
+            yield offset, block_type, length, byte_order
+            offset += length
+
+    def pcapng_records(self, start, end):
+        view = self.view
+        interfaces = [] # (linktype, snaplen, units per second, offset seconds) by interface id
+        for offset, block_type, length, byte_order in self.blocks():
+            body = offset + 8
+            if block_type == SECTION_HEADER: # the interfaces of a new section start over
+                interfaces = []
+            elif block_type == INTERFACE_DESCRIPTION:
+                linktype, _, snaplen = struct.unpack_from(byte_order + 'HHI', view, body)
+                resolution, time_offset = interface_options(view, body + 8, offset + length - 4, byte_order)
+                interfaces.append((linktype, snaplen, resolution, time_offset))
+                if self.linktype is None:
+                    self.linktype = linktype
+            elif offset >= end:
+                return
+            elif offset < start:
+                pass
+            elif block_type == ENHANCED_PACKET:
+                interface, high, low, captured, _ = struct.unpack_from(byte_order + 'IIIII', view, body)
+                _, _, resolution, time_offset = interfaces[interface]
+                yield offset, time_offset + ((high << 32) | low) / resolution, view[body + 20:body + 20 + captured]
+            elif block_type == OBSOLETE_PACKET:
+                interface, _, high, low, captured, _ = struct.unpack_from(byte_order + 'HHIIII', view, body)
+                _, _, resolution, time_offset = interfaces[interface]
+                yield offset, time_offset + ((high << 32) | low) / resolution, view[body + 20:body + 20 + captured]
+            elif block_type == SIMPLE_PACKET: # no timestamp, nor interface id: always the first interface
+                original, = struct.unpack_from(byte_order + 'I', view, body)
+                snaplen = interfaces[0][1] if interfaces else 0
+                captured = min(original, snaplen or original, length - 16)
+                yield offset, 0.0, view[body + 4:body + 4 + captured]
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError: # frames still in use, the mapping goes away with the last of them
+            pass
+        self.file.close()
+
+
+def interface_options(view, offset, end, byte_order):
+    '''
+    (timestamp units per second, seconds added to timestamps) from the options of an interface description
+    '''
+    resolution, time_offset = 1e6, 0
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(byte_order + 'HH', view, offset)
+        if code == 0:
+            break
+        value = offset + 4
+        if code == IF_TSRESOL and length >= 1:
+            exponent = view[value]
+            resolution = 2.0 ** (exponent & 0x7f) if exponent & 0x80 else 10.0 ** exponent
+        elif code == IF_TSOFFSET and length >= 8:
+            time_offset, = struct.unpack_from(byte_order + 'q', view, value)
+        offset = value + (length + 3) // 4 * 4
+    return resolution, time_offset
@@ -0,0 +1,181 @@
+'''
+Unit tests for pcap_reader.py: both byte orders, nanosecond timestamps, pcapng, resync and split.
+The captures are built here with struct, run with python -m unittest (or pytest) from this directory.
+'''
+import os
+import struct
+import tempfile
+import unittest
+
+from pcap_reader import PCAP_HEADER, RESYNC_RECORDS, PcapReader, interface_options
+
+# (timestamp seconds, fraction in the file's units, frame)
+PACKETS = [(1000, 1, b"first"), (1000, 999999, b"second frame"), (1001, 500000, b""), (1002, 0, b"x" * 300)]
+
+
+def pcap_bytes(byte_order, magic, packets=PACKETS, snaplen=65535):
+    data = struct.pack(byte_order + 'IHHiIII', magic, 2, 4, 0, 0, snaplen, 1)
+    for seconds, fraction, frame in packets:
+        data += struct.pack(byte_order + 'IIII', seconds, fraction, len(frame), len(frame)) + frame
+    return data
+
+
+def pad(data):
+    return data + b"\0" * (-len(data) % 4)
+
+
+def pcapng_block(byte_order, block_type, body):
+    body = pad(body)
+    length = len(body) + 12
+    return struct.pack(byte_order + 'II', block_type, length) + body + struct.pack(byte_order + 'I', length)
+
+
+def pcapng_bytes(byte_order, options=b"", packets=PACKETS, units=10 ** 6):
+    data = pcapng_block(byte_order, 0x0A0D0D0A, struct.pack(byte_order + 'IHHq', 0x1A2B3C4D, 1, 0, -1))
+    data += pcapng_block(byte_order, 0x00000001, struct.pack(byte_order + 'HHI', 1, 0, 65535) + options)
+    for seconds, fraction, frame in packets:
+        stamp = seconds * units + fraction
+        body = struct.pack(byte_order + 'IIIII', 0, stamp >> 32, stamp & 0xffffffff, len(frame), len(frame))
+        data += pcapng_block(byte_order, 0x00000006, body + frame)
+    return data
+
+
+def option(byte_order, code, value):
+    return struct.pack(byte_order + 'HH', code, len(value)) + pad(value)
+
+
+class ReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, data):
+        path = os.path.join(self.directory.name, 'capture')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read(self, data):
+        '''
+        The reader's format, resolution and records as (offset, timestamp, frame bytes)
+        '''
+        with PcapReader(self.write(data)) as reader:
+            records = [(offset, timestamp, bytes(frame)) for offset, timestamp, frame in reader.records()]
+            return reader.format, getattr(reader, 'resolution', None), records
+
+    def test_formats(self):
+        micro = [seconds + fraction / 1e6 for seconds, fraction, _ in PACKETS]
+        nano = [seconds + fraction / 1e9 for seconds, fraction, _ in PACKETS]
+        cases = [
+            ('pcap little-endian', pcap_bytes('<', 0xa1b2c3d4), 'pcap', 1e6, micro),
+            ('pcap big-endian', pcap_bytes('>', 0xa1b2c3d4), 'pcap', 1e6, micro),
+            ('pcap nanoseconds', pcap_bytes('<', 0xa1b23c4d), 'pcap', 1e9, nano),
+            ('pcap nanoseconds big-endian', pcap_bytes('>', 0xa1b23c4d), 'pcap', 1e9, nano),
+            ('pcapng little-endian', pcapng_bytes('<'), 'pcapng', None, micro),
+            ('pcapng big-endian', pcapng_bytes('>'), 'pcapng', None, micro),
+            ('pcapng nanoseconds', pcapng_bytes('<', option('<', 9, b"\x09") + option('<', 0, b""), units=10 ** 9),
+             'pcapng', None, nano),
+        ]
+        for name, data, file_format, resolution, timestamps in cases:
+            with self.subTest(name):
+                found_format, found_resolution, records = self.read(data)
+                self.assertEqual(found_format, file_format)
+                self.assertEqual(found_resolution, resolution)
+                self.assertEqual([frame for _, _, frame in records], [frame for _, _, frame in PACKETS])
+                self.assertEqual([timestamp for _, timestamp, _ in records], timestamps)
+
+    def test_iter_and_linktype(self):
+        for data in (pcap_bytes('>', 0xa1b2c3d4), pcapng_bytes('>')):
+            with self.subTest(data[:4]), PcapReader(self.write(data)) as reader:
+                self.assertEqual([bytes(frame) for _, frame in reader], [frame for _, _, frame in PACKETS])
+                self.assertEqual(reader.linktype, 1)
+
+    def test_truncated(self):
+        data = pcap_bytes('<', 0xa1b2c3d4)
+        _, _, records = self.read(data[:-10]) # the last record is cut off
+        self.assertEqual(len(records), len(PACKETS) - 1)
+
+    def test_not_a_capture(self):
+        for data in (b"", b"abc", b"GIF89a" + b"\0" * 30, struct.pack('<I', 0xa1b2c3d4)):
+            with self.subTest(data=data[:8]):
+                with self.assertRaises(ValueError):
+                    PcapReader(self.write(data))
+
+    def test_interface_options(self):
+        cases = [
+            ('<', b"", (1e6, 0)),
+            ('<', option('<', 9, b"\x03") + option('<', 0, b""), (1e3, 0)),
+            ('>', option('>', 9, b"\x8a"), (2.0 ** 10, 0)),
+            ('<', option('<', 2, b"eth0") + option('<', 14, struct.pack('<q', 3600)), (1e6, 3600)),
+            ('<', option('<', 0, b"") + option('<', 9, b"\x09"), (1e6, 0)), # after the end of options
+        ]
+        for byte_order, options, expected in cases:
+            with self.subTest(options=options):
+                self.assertEqual(interface_options(options, 0, len(options), byte_order), expected)
+
+    def test_records_at(self):
+        for data in (pcap_bytes('<', 0xa1b2c3d4), pcapng_bytes('<')):
+            with self.subTest(data[:4]), PcapReader(self.write(data)) as reader:
+                offsets = [offset for offset, _, _ in reader.records()]
+                wanted = [offsets[1], offsets[3]]
+                self.assertEqual([bytes(frame) for _, frame in reader.records_at(wanted)],
+                                 [PACKETS[1][2], PACKETS[3][2]])
+
+
+class ResyncTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def capture(self, packets):
+        path = os.path.join(self.directory.name, 'capture')
+        with open(path, 'wb') as f:
+            f.write(pcap_bytes('<', 0xa1b2c3d4, packets))
+        return PcapReader(path)
+
+    def check_split(self, reader, packets, exact):
+        for parts in (1, 2, 3, 7, 100):
+            with self.subTest(parts=parts, exact=exact):
+                bounds = reader.split(parts, exact)
+                self.assertEqual(len(bounds), parts + 1)
+                self.assertEqual(bounds, sorted(bounds))
+                frames = [bytes(frame) for start, end in zip(bounds, bounds[1:])
+                          for _, _, frame in reader.records(start, end)]
+                self.assertEqual(frames, [frame for _, _, frame in packets])
+
+    def test_resync(self):
+        # Frames of zero bytes and frames whose bytes pass for one record header, neither is a record boundary
+        packets = [(1000 + i, i * 1000, struct.pack('<IIII', 1005, 0, 8, 8) * (i % 4 + 1) if i % 2 else
+                    b"\0" * 200 + b"end of frame") for i in range(40)]
+        with self.capture(packets) as reader:
+            offsets = [offset for offset, _, _ in reader.records()]
+            self.assertEqual(offsets[0], PCAP_HEADER)
+            for offset in range(0, reader.size + 1):
+                with self.subTest(offset=offset):
+                    expected = next((record for record in offsets if record >= offset), reader.size)
+                    self.assertEqual(reader.resync(offset), expected)
+            self.check_split(reader, packets, False)
+            self.check_split(reader, packets, True)
+
+    def test_fooled_resync(self):
+        # Frames holding a whole chain of plausible records, which resync can't tell from the real ones.
+        # range_end shows the wrong bounds and an exact split doesn't depend on resync.
+        chain = (struct.pack('<IIII', 1005, 0, 20, 20) + b"a" * 20) * RESYNC_RECORDS
+        packets = [(1000 + i, 0, chain if i % 2 else b"x" * 100) for i in range(40)]
+        with self.capture(packets) as reader:
+            offsets = [offset for offset, _, _ in reader.records()]
+            guessed = {bound for parts in range(2, 40) for bound in reader.split(parts)}
+            self.assertFalse(guessed <= set(offsets) | {reader.size})
+            for end in range(PCAP_HEADER, reader.size + 1):
+                with self.subTest(end=end):
+                    expected = next((record for record in offsets if record >= end), reader.size)
+                    self.assertEqual(reader.range_end(PCAP_HEADER, end), expected)
+            self.check_split(reader, packets, True)
+
+
+if __name__ == '__main__':
+    unittest.main()